@@ -4,19 +4,55 @@ from model.anchor import Anchors
 
 cfg = EasyDict()
 
-cfg.dataset = "wider_face"
+cfg.dataset = "wider_face"  # coco, wider_face, synthetic or local
 cfg.grid_sensitivity_ratio = 1.1
 cfg.yolo_score_threshold = 0.5
 cfg.yolo_iou_threshold = 0.45
+cfg.pre_nms_top_k = 1000  # candidates per image kept before nms, 0 keeps every anchor
+cfg.nms_engine = "combined"  # combined, batched (class offset), or diou, matrix, soft which need pre_nms_top_k > 0
 cfg.label_smoothing_factor = 0.1
+cfg.loss_from_logits = False  # fused sigmoid cross entropy on the raw outputs instead of BCE on probabilities
 cfg.image_size = 608
-cfg.buffer_size = 100
+cfg.aspect_ratio_buckets = []  # [(height, width), ...] multiples of 32, e.g. [(352, 608), (608, 608), (608, 352)]
+cfg.buffer_size = 1000  # shuffle buffer of encoded records
 cfg.batch_size = 4
 cfg.prefetch_size = 5
+cfg.num_parallel_calls = -1  # -1 = tf.data.experimental.AUTOTUNE
+cfg.interleave_cycle_length = 16  # number of tfds shards read in parallel
+cfg.interleave_block_length = 16
+cfg.ram_budget = 0  # bytes of host memory tf.data autotune may use, 0 = tf.data default
+cfg.deterministic = True  # False trades element order for throughput
+cfg.cache_dir = "./cache"  # preprocessed TFRecords written by preprocess.py
+cfg.cache_num_shards = 64
+cfg.use_cache = True  # read the cache when one matches the dataset, image size and anchors
+cfg.uint8_image = False  # carry uint8 images through the pipeline, augment and normalize inside the train step
+cfg.compact_label = True  # only ship the padded bbox, YOLOv4Loss builds the label grids on device
+cfg.synthetic_num_of_img = 1000  # procedural training images, validation gets a tenth
+cfg.synthetic_num_class = 80
+cfg.synthetic_max_bbox_per_image = 20  # each image draws 1 to n boxes
+cfg.synthetic_image_sizes = [(480, 640), (640, 480)]  # (height, width) before letterboxing, used in turn
+cfg.synthetic_seed = 0
+cfg.local_annotation_format = "coco"  # coco (instances json) or voc (ImageSets/Main/<split>.txt of a VOC root)
+cfg.local_annotations = {"train": "./data/annotations/instances_train.json",
+                         "validation": "./data/annotations/instances_val.json"}
+cfg.local_image_dirs = {"train": "./data/train", "validation": "./data/val"}  # voc defaults to <root>/JPEGImages
+cfg.local_class_names = []  # empty takes the json categories or the 20 VOC classes
+cfg.local_index_dir = "./cache/index"  # memory-mapped annotation index, built on first use
 cfg.lr_init = 1e-3
 cfg.lr_end = 1e-6
 cfg.warmup_epochs = 30
 cfg.train_epochs = 300
 cfg.step_to_log = 250
+cfg.steps_per_execution = 1  # train steps looped inside one tf.function call, python syncs at log boundaries
+cfg.gradient_accumulation_steps = 1  # batches summed per optimizer update, effective batch = batch_size * n
+cfg.distribute_strategy = ""  # empty trains on one device, mirrored or multi_worker (reads TF_CONFIG)
+cfg.num_virtual_devices = 0  # split the CPU into n logical devices to test multi replica training
+cfg.sync_batch_norm = True  # all-reduce batchnorm statistics across replicas
+cfg.eval_num_of_batch = 1  # fixed batches evaluated at every log step
+cfg.eval_cache_dir = ""  # empty keeps the evaluation batches in memory, else cache them to disk here
 cfg.max_bbox_size = 300
-cfg.anchors = Anchors(cfg.image_size)
+cfg.static_shape = False  # fixed batch and bbox shapes (drop_remainder, pad to max_bbox_size), masked ignore loss
+cfg.jit_compile = False  # XLA compile the forward and backward pass, needs static_shape
+cfg.multi_scale_image_sizes = []  # e.g. list(range(320, 609, 32)), empty trains at cfg.image_size only
+cfg.multi_scale_steps = 10  # train steps between image size changes
+cfg.anchors = Anchors()
@@ -0,0 +1,395 @@
+import hashlib
+import json
+import os
+import shutil
+from typing import Dict, Tuple, Any, List, Union
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_datasets as tfds
+
+from config import cfg
+from model.utils import encode_label, get_decode_table
+
+
+class YOLOv4Dataset:
+    def __init__(
+            self,
+            dataset: str,
+            mode: Any = tfds.Split.TRAIN,
+            image_size: int = cfg.image_size,
+            batch_size: int = cfg.batch_size,
+            buffer_size: int = cfg.buffer_size,
+            prefetch_size: int = cfg.prefetch_size,
+            num_parallel_calls: int = cfg.num_parallel_calls,
+            interleave_cycle_length: int = cfg.interleave_cycle_length,
+            interleave_block_length: int = cfg.interleave_block_length,
+            ram_budget: int = cfg.ram_budget,
+            deterministic: bool = cfg.deterministic,
+            cache_dir: str = cfg.cache_dir,
+            use_cache: bool = cfg.use_cache,
+            uint8_image: bool = cfg.uint8_image,
+            compact_label: bool = cfg.compact_label,
+            aspect_ratio_buckets: List[Tuple[int, int]] = cfg.aspect_ratio_buckets,
+            static_shape: bool = cfg.static_shape,
+            max_bbox_size: int = cfg.max_bbox_size
+    ):
+        self.image_size = image_size
+        # (height, width) of each aspect ratio bucket, images are letterboxed into the closest one
+        self.image_shapes = [tuple(shape) for shape in aspect_ratio_buckets] or [(image_size, image_size)]
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.prefetch_size = prefetch_size
+        self.num_parallel_calls = num_parallel_calls
+        self.interleave_cycle_length = interleave_cycle_length
+        self.interleave_block_length = interleave_block_length
+        self.ram_budget = ram_budget
+        self.deterministic = deterministic
+        self.uint8_image = uint8_image
+        self.compact_label = compact_label
+        self.static_shape = static_shape
+        self.max_bbox_size = max_bbox_size
+        self.anchor_masks = cfg.anchors.get_anchor_masks()
+        self.cache_path = os.path.join(cache_dir, self.get_cache_key(dataset, mode))
+
+        # read the preprocessed cache when one matches, tfds is only needed to build it
+        self.use_cache = use_cache and os.path.exists(os.path.join(self.cache_path, "meta.json"))
+        self.dataset = self.load_cache() if self.use_cache else self.load_dataset(dataset, mode)
+
+    def load_dataset(self, dataset: str, mode: Any) -> tf.data.Dataset:
+        # shuffle and interleave shards while images are still encoded, decode happens in map_func
+        read_config = tfds.ReadConfig(
+            interleave_cycle_length=self.interleave_cycle_length,
+            interleave_block_length=self.interleave_block_length
+        )
+
+        return tfds.load(name=dataset, split=mode, shuffle_files=True, read_config=read_config,
+                         decoders={"image": tfds.decode.SkipDecoding()})
+
+    def get_cache_key(self, dataset: str, mode: Any) -> str:
+        # a cache is only valid for the same dataset version, image size and anchors
+        key = json.dumps({
+            "dataset": dataset,
+            "version": str(tfds.builder(dataset).version),
+            "split": str(mode),
+            "image_shapes": self.image_shapes,
+            "anchors": cfg.anchors.yolo_anchors.tolist(),
+            "anchor_masks": self.anchor_masks.tolist()
+        }, sort_keys=True)
+        key = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+        return "{}_{}_{}".format(dataset.replace("/", "_"), mode, key)
+
+    def load_cache(self) -> tf.data.Dataset:
+        files = tf.data.Dataset.list_files(os.path.join(self.cache_path, "*.tfrecord"), shuffle=True)
+        dataset = files.interleave(tf.data.TFRecordDataset, cycle_length=self.interleave_cycle_length,
+                                   block_length=self.interleave_block_length,
+                                   num_parallel_calls=self.num_parallel_calls)
+
+        return dataset
+
+    def get_bbox_and_label(self, feature: Dict) -> Tuple[tf.Tensor, tf.Tensor]:
+        # return bbox = [[y_min, x_min, y_max, x_max], ...] and label = [class_id, ...] of a record
+        raise NotImplementedError
+
+    def decode_image(self, feature: Dict) -> tf.Tensor:
+        return tf.io.decode_image(feature["image"], channels=3, expand_animations=False)
+
+    def get_image_shape(self, original_image_size: tf.Tensor) -> Union[Tuple[int, int], tf.Tensor]:
+        # a single bucket keeps the shape static
+        if len(self.image_shapes) == 1:
+            return self.image_shapes[0]
+
+        # pick the bucket with the closest aspect ratio
+        image_shapes = tf.constant(self.image_shapes, tf.float32)
+        original_image_size = tf.cast(original_image_size, tf.float32)
+        bucket_ratio = tf.math.log(image_shapes[:, 1] / image_shapes[:, 0])
+        image_ratio = tf.math.log(original_image_size[1] / original_image_size[0])
+        bucket = tf.argmin(tf.abs(bucket_ratio - image_ratio))
+
+        return tf.gather(tf.constant(self.image_shapes, tf.int32), bucket)
+
+    def get_bucket(self, image: tf.Tensor) -> tf.Tensor:
+        image_shapes = tf.constant(self.image_shapes, tf.int32)
+        return tf.argmax(tf.cast(tf.reduce_all(tf.equal(image_shapes, tf.shape(image)[0:2]), axis=-1), tf.int32))
+
+    @staticmethod
+    def get_grid_sizes(image_shape: Union[Tuple[int, int], tf.Tensor]) -> List[Tuple]:
+        # (grid_y, grid_x) of the stride 32, 16 and 8 outputs
+        return get_decode_table(image_shape).grid_sizes
+
+    def map_func(self, feature: Dict) -> Dict:
+        image = self.decode_image(feature)
+        bbox, label = self.get_bbox_and_label(feature)
+        num_of_bbox = tf.shape(bbox)[0]
+
+        original_image_size = tf.shape(image)[0:2]
+        image_shape = self.get_image_shape(original_image_size)
+        bbox = self.transform_bbox(bbox, original_image_size, image_shape)
+
+        image = self.map_image_func(self.letterbox_image(image, image_shape))
+
+        feature_dict = {
+            "image": image,
+            "bbox": self.pad_class(bbox, label),
+            "num_of_bbox": num_of_bbox
+        }
+
+        # with compact labels YOLOv4Loss builds the label grids from "bbox" on device
+        if not self.compact_label:
+            feature_dict["label"] = self.map_label_func(bbox, label, image_shape)
+
+        return feature_dict
+
+    def map_label_func(self, bbox: tf.Tensor, label: tf.Tensor, image_shape: Union[Tuple[int, int], tf.Tensor]) -> \
+            Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+        # bbox.shape = (n, 4)
+        # label.shape = (n)
+        table = get_decode_table(image_shape)
+        label_small, label_medium, label_large = encode_label(
+            bbox=tf.expand_dims(bbox, axis=0),
+            label=tf.expand_dims(label, axis=0),
+            num_class=self.num_class,
+            grid_sizes=table.grid_sizes,
+            anchors=table.anchors,
+            anchor_masks=self.anchor_masks
+        )
+
+        return label_small[0], label_medium[0], label_large[0]
+
+    def letterbox_image(self, image: tf.Tensor, image_shape: Union[Tuple[int, int], tf.Tensor]) -> tf.Tensor:
+        img = tf.image.resize(image, image_shape, preserve_aspect_ratio=True)
+        img = tf.image.pad_to_bounding_box(img, 0, 0, image_shape[0], image_shape[1])
+
+        return img
+
+    def augment_image(self, image: tf.Tensor) -> tf.Tensor:
+        # image: (..., h, w, c), called per image in the pipeline or per batch on device
+        return image
+
+    def normalize_image(self, image: tf.Tensor) -> tf.Tensor:
+        # image: letterboxed image(s) in [0, 255], normalized to [-1, 1] without augmentation
+        return tf.cast(image, tf.float32) / 127.5 - 1
+
+    def preprocess_image(self, image: tf.Tensor) -> tf.Tensor:
+        # image: letterboxed image(s) in [0, 255]
+        img = self.augment_image(tf.cast(image, tf.float32))
+
+        return self.normalize_image(img)
+
+    def map_image_func(self, image: tf.Tensor) -> tf.Tensor:
+        if self.uint8_image:
+            # keep 1 byte per pixel through shuffle and prefetch, Trainer calls preprocess_image on device
+            return image if image.dtype == tf.uint8 else tf.saturate_cast(tf.round(image), tf.uint8)
+
+        return self.preprocess_image(image)
+
+    def transform_bbox(self, bbox: tf.Tensor, original_image_size: tf.Tensor,
+                       image_shape: Union[Tuple[int, int], tf.Tensor]) -> tf.Tensor:
+        # bbox = [y_min, x_min, y_max, x_max] => [x_min, y_min, x_max, y_max]
+        # bbox.shape: (n, 4)
+        bbox = tf.gather(bbox, [1, 0, 3, 2], axis=-1)
+
+        # rescale bbox to fit new image size
+        orig_img_h, orig_img_w = tf.unstack(tf.cast(original_image_size, tf.float64))
+        target_img_h, target_img_w = tf.unstack(tf.cast(image_shape, tf.float64))
+        ratio = tf.minimum(target_img_w / orig_img_w, target_img_h / orig_img_h)
+        ratio_w = ratio * (orig_img_w / target_img_w)
+        ratio_h = ratio * (orig_img_h / target_img_h)
+
+        multiplier = tf.cast(tf.stack([ratio_w, ratio_h, ratio_w, ratio_h]), tf.float32)
+
+        bbox = bbox * multiplier
+
+        return bbox
+
+    def pad_class(self, bbox: tf.Tensor, label: tf.Tensor) -> tf.Tensor:
+        # bbox.shape = (n, 4)
+        # label.shape = (n)
+        label = tf.cast(tf.reshape(label, (-1, 1)), tf.float32)
+        label = tf.concat([bbox, label], axis=-1)
+        return label
+
+    def map_cache_record_func(self, feature: Dict) -> Dict:
+        # everything map_func computes except the random augmentation
+        image = self.decode_image(feature)
+        bbox, label = self.get_bbox_and_label(feature)
+
+        original_image_size = tf.shape(image)[0:2]
+        image_shape = self.get_image_shape(original_image_size)
+        bbox = self.transform_bbox(bbox, original_image_size, image_shape)
+        labels = self.map_label_func(bbox, label, image_shape)
+        image = tf.saturate_cast(tf.round(self.letterbox_image(image, image_shape)), tf.uint8)
+
+        # only keep the assigned cells of the sparse label grids
+        indices = [tf.where(label_grid[..., 4] > 0) for label_grid in labels]
+        values = [tf.gather_nd(label_grid, index) for label_grid, index in zip(labels, indices)]
+
+        return {
+            "image": image,
+            "bbox": self.pad_class(bbox, label),
+            "label_index": tuple(indices),
+            "label_value": tuple(values)
+        }
+
+    @staticmethod
+    def serialize_cache_record(record: Dict) -> bytes:
+        def bytes_feature(value):
+            return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+        def float_feature(value):
+            return tf.train.Feature(float_list=tf.train.FloatList(value=value.reshape(-1)))
+
+        def int64_feature(value):
+            return tf.train.Feature(int64_list=tf.train.Int64List(value=value.reshape(-1)))
+
+        feature = {
+            "image": bytes_feature(record["image"].numpy().tobytes()),
+            "image_shape": int64_feature(np.array(record["image"].shape[0:2])),
+            "bbox": float_feature(record["bbox"].numpy())
+        }
+        for i, (index, value) in enumerate(zip(record["label_index"], record["label_value"])):
+            feature["label_index_{}".format(i)] = int64_feature(index.numpy())
+            feature["label_value_{}".format(i)] = float_feature(value.numpy())
+
+        example = tf.train.Example(features=tf.train.Features(feature=feature))
+
+        return example.SerializeToString()
+
+    def write_cache(self, num_shards: int = cfg.cache_num_shards):
+        if os.path.exists(os.path.join(self.cache_path, "meta.json")):
+            print("Cache already exists: {}".format(self.cache_path))
+            return
+
+        # write into a temporary directory so a partial cache or shards of an aborted run are never picked up
+        tmp_path = self.cache_path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        dataset = self.dataset.filter(lambda x: tf.shape(self.get_bbox_and_label(x)[0])[0] != 0) \
+            .map(self.map_cache_record_func, num_parallel_calls=self.num_parallel_calls) \
+            .prefetch(self.prefetch_size)
+
+        writers = [tf.io.TFRecordWriter(os.path.join(tmp_path, "shard-{:05d}-of-{:05d}.tfrecord".format(
+            i, num_shards))) for i in range(num_shards)]
+        num_of_img = 0
+        for record in dataset:
+            writers[num_of_img % num_shards].write(self.serialize_cache_record(record))
+            num_of_img += 1
+        for writer in writers:
+            writer.close()
+
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"num_of_img": num_of_img, "num_shards": num_shards, "image_shapes": self.image_shapes}, f)
+        # a cache directory without meta.json is left over from an older partial write
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+        os.replace(tmp_path, self.cache_path)
+        print("Wrote {} images to {}".format(num_of_img, self.cache_path))
+
+    def map_cached_func(self, record: tf.Tensor) -> Dict:
+        feature_description = {
+            "image": tf.io.FixedLenFeature([], tf.string),
+            "image_shape": tf.io.FixedLenFeature([2], tf.int64),
+            "bbox": tf.io.VarLenFeature(tf.float32)
+        }
+        for i in range(len(self.anchor_masks)):
+            feature_description["label_index_{}".format(i)] = tf.io.VarLenFeature(tf.int64)
+            feature_description["label_value_{}".format(i)] = tf.io.VarLenFeature(tf.float32)
+        feature = tf.io.parse_single_example(record, feature_description)
+
+        image_shape = self.image_shapes[0] if len(self.image_shapes) == 1 else tf.cast(feature["image_shape"],
+                                                                                        tf.int32)
+        image = tf.io.decode_raw(feature["image"], tf.uint8)
+        image = tf.reshape(image, (image_shape[0], image_shape[1], 3))
+        image = self.map_image_func(image)
+
+        bbox = tf.reshape(tf.sparse.to_dense(feature["bbox"]), (-1, 5))
+        num_of_bbox = tf.shape(bbox)[0]
+
+        feature_dict = {
+            "image": image,
+            "bbox": bbox,
+            "num_of_bbox": num_of_bbox
+        }
+        if self.compact_label:
+            return feature_dict
+
+        # scatter the assigned cells back into the label grids
+        labels = []
+        for i, (grid_h, grid_w) in enumerate(self.get_grid_sizes(image_shape)):
+            index = tf.reshape(tf.sparse.to_dense(feature["label_index_{}".format(i)]), (-1, 3))
+            value = tf.reshape(tf.sparse.to_dense(feature["label_value_{}".format(i)]), (-1, 5 + self.num_class))
+            labels.append(tf.scatter_nd(index, value, (grid_h, grid_w, len(self.anchor_masks[i]),
+                                                       5 + self.num_class)))
+        feature_dict["label"] = tuple(labels)
+
+        return feature_dict
+
+    def get_options(self) -> tf.data.Options:
+        options = tf.data.Options()
+        options.experimental_deterministic = self.deterministic
+        if self.ram_budget > 0:
+            options.autotune.ram_budget = self.ram_budget
+
+        return options
+
+    def get_dataset(self) -> tf.data.Dataset:
+        if self.use_cache:
+            # empty images were dropped when the cache was written
+            dataset = self.dataset.shuffle(self.buffer_size) \
+                .map(self.map_cached_func, num_parallel_calls=self.num_parallel_calls)
+        else:
+            # filter and shuffle the encoded records, only decode the images that are kept
+            dataset = self.dataset.filter(lambda x: tf.shape(self.get_bbox_and_label(x)[0])[0] != 0) \
+                .shuffle(self.buffer_size) \
+                .map(self.map_func, num_parallel_calls=self.num_parallel_calls)
+
+        dataset = self.batch(dataset) \
+            .prefetch(self.prefetch_size) \
+            .with_options(self.get_options())
+
+        return dataset
+
+    def batch(self, dataset: tf.data.Dataset) -> tf.data.Dataset:
+        if self.static_shape:
+            return self.static_batch(dataset)
+
+        # bbox has a different length per image and is batched into a tf.RaggedTensor
+        if len(self.image_shapes) == 1:
+            return dataset.apply(tf.data.experimental.dense_to_ragged_batch(self.batch_size))
+
+        # every batch holds images of one aspect ratio bucket
+        dataset = dataset.apply(tf.data.experimental.group_by_window(
+            key_func=lambda x: self.get_bucket(x["image"]),
+            reduce_func=lambda _, window: window.padded_batch(self.batch_size),
+            window_size=self.batch_size
+        ))
+
+        return dataset.map(self.ragged_bbox_func, num_parallel_calls=self.num_parallel_calls)
+
+    def static_batch(self, dataset: tf.data.Dataset) -> tf.data.Dataset:
+        # every batch has the same shape so a jit compiled train step never retraces,
+        # bbox is padded to max_bbox_size and the last incomplete batch is dropped
+        dataset = dataset.map(self.pad_bbox_func, num_parallel_calls=self.num_parallel_calls)
+        if len(self.image_shapes) == 1:
+            return dataset.batch(self.batch_size, drop_remainder=True)
+
+        return dataset.apply(tf.data.experimental.group_by_window(
+            key_func=lambda x: self.get_bucket(x["image"]),
+            reduce_func=lambda _, window: window.batch(self.batch_size, drop_remainder=True),
+            window_size=self.batch_size
+        ))
+
+    def pad_bbox_func(self, feature: Dict) -> Dict:
+        # boxes beyond max_bbox_size are dropped
+        feature = dict(feature)
+        bbox = feature["bbox"][:self.max_bbox_size]
+        feature["bbox"] = tf.pad(bbox, [[0, self.max_bbox_size - tf.shape(bbox)[0]], [0, 0]])
+        feature["bbox"].set_shape((self.max_bbox_size, 5))
+        feature["num_of_bbox"] = tf.minimum(feature["num_of_bbox"], self.max_bbox_size)
+        return feature
+
+    @staticmethod
+    def ragged_bbox_func(feature: Dict) -> Dict:
+        feature = dict(feature)
+        feature["bbox"] = tf.RaggedTensor.from_tensor(feature["bbox"], lengths=feature["num_of_bbox"])
+        return feature
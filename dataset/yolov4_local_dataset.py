@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+import shutil
+import xml.etree.ElementTree as ET
+from typing import Dict, Tuple, Any, List
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_datasets as tfds
+
+from config import cfg
+from dataset.voc_classes import voc_classes
+from dataset.yolov4_dataset import YOLOv4Dataset
+from utils.augmentation import random_brightness, random_contrast, random_hue, random_saturation
+
+INDEX_FILES = ["paths", "path_offsets", "bbox", "label", "bbox_offsets"]
+
+
+class LocalDataset(YOLOv4Dataset):
+    # COCO-JSON or VOC annotations on local disk, parsed once into a numpy index that is loaded into tensors
+    def __init__(
+            self,
+            dataset: str = "local",
+            mode: Any = tfds.Split.TRAIN,
+            image_size: int = cfg.image_size,
+            batch_size: int = cfg.batch_size,
+            buffer_size: int = cfg.buffer_size,
+            prefetch_size: int = cfg.prefetch_size,
+            annotation_format: str = cfg.local_annotation_format,
+            annotations: Dict[str, str] = cfg.local_annotations,
+            image_dirs: Dict[str, str] = cfg.local_image_dirs,
+            class_names: List[str] = cfg.local_class_names,
+            index_dir: str = cfg.local_index_dir,
+            **kwargs
+    ):
+        # the index is needed by get_cache_key and load_dataset in the base class
+        self.annotation_format = annotation_format
+        self.annotation_path = annotations[str(mode)]
+        self.image_dir = image_dirs.get(str(mode), "")
+        self.split = str(mode)
+        self.index_path = os.path.join(index_dir, self.get_index_key(class_names))
+        if not os.path.exists(os.path.join(self.index_path, "meta.json")):
+            self.write_index(class_names)
+        self.index, meta = self.load_index()
+        self.num_of_img = meta["num_of_img"]
+        self.class_names = meta["class_names"]
+        self.num_class = len(self.class_names)
+
+        super(LocalDataset, self).__init__(dataset=dataset, mode=mode, image_size=image_size,
+                                           batch_size=batch_size, buffer_size=buffer_size,
+                                           prefetch_size=prefetch_size, **kwargs)
+
+    def get_index_key(self, class_names: List[str]) -> str:
+        # the index is rebuilt whenever the annotation file changes
+        stat = os.stat(self.annotation_path)
+        key = json.dumps({
+            "format": self.annotation_format,
+            "annotations": os.path.abspath(self.annotation_path),
+            "image_dir": os.path.abspath(self.image_dir),
+            "split": self.split,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "class_names": class_names
+        }, sort_keys=True)
+
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+    def get_cache_key(self, dataset: str, mode: Any) -> str:
+        key = json.dumps({
+            "index": os.path.basename(self.index_path),
+            "image_shapes": self.image_shapes,
+            "anchors": cfg.anchors.yolo_anchors.tolist(),
+            "anchor_masks": self.anchor_masks.tolist()
+        }, sort_keys=True)
+        key = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+        return "{}_{}_{}".format(dataset, mode, key)
+
+    def parse_coco(self, class_names: List[str]) -> Tuple[List[str], List[np.ndarray], List[np.ndarray], List[str]]:
+        with open(self.annotation_path) as f:
+            annotations = json.load(f)
+
+        # category ids are sparse in COCO-JSON, map them to [0, num_class) in id order
+        categories = sorted(annotations["categories"], key=lambda x: x["id"])
+        class_names = class_names or [category["name"] for category in categories]
+        category_index = {category["id"]: class_names.index(category["name"]) for category in categories
+                          if category["name"] in class_names}
+
+        images = {image["id"]: image for image in annotations["images"]}
+        boxes = {image_id: [] for image_id in images}
+        for obj in annotations["annotations"]:
+            if obj.get("iscrowd", 0) or obj["category_id"] not in category_index:
+                continue
+            image = images[obj["image_id"]]
+            x, y, w, h = obj["bbox"]
+            boxes[obj["image_id"]].append([y / image["height"], x / image["width"], (y + h) / image["height"],
+                                           (x + w) / image["width"], category_index[obj["category_id"]]])
+
+        paths, bboxes, labels = [], [], []
+        for image_id, image_boxes in boxes.items():
+            if not image_boxes:
+                continue
+            image_boxes = np.array(image_boxes, np.float32)
+            paths.append(os.path.join(self.image_dir, images[image_id]["file_name"]))
+            bboxes.append(image_boxes[:, 0:4])
+            labels.append(image_boxes[:, 4].astype(np.int32))
+
+        return paths, bboxes, labels, class_names
+
+    def parse_voc(self, class_names: List[str]) -> Tuple[List[str], List[np.ndarray], List[np.ndarray], List[str]]:
+        # annotation_path is an ImageSets/Main/<split>.txt of a VOC root
+        class_names = class_names or voc_classes
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(self.annotation_path))))
+        image_dir = self.image_dir or os.path.join(root, "JPEGImages")
+        with open(self.annotation_path) as f:
+            image_ids = [line.split()[0] for line in f if line.strip()]
+
+        paths, bboxes, labels = [], [], []
+        for image_id in image_ids:
+            tree = ET.parse(os.path.join(root, "Annotations", image_id + ".xml")).getroot()
+            height = float(tree.find("size/height").text)
+            width = float(tree.find("size/width").text)
+            image_boxes, image_labels = [], []
+            for obj in tree.findall("object"):
+                name = obj.find("name").text.strip()
+                if name not in class_names or int(getattr(obj.find("difficult"), "text", 0) or 0):
+                    continue
+                box = obj.find("bndbox")
+                x_min, y_min, x_max, y_max = [float(box.find(k).text) for k in ["xmin", "ymin", "xmax", "ymax"]]
+                image_boxes.append([y_min / height, x_min / width, y_max / height, x_max / width])
+                image_labels.append(class_names.index(name))
+            if not image_boxes:
+                continue
+            paths.append(os.path.join(image_dir, tree.findtext("filename", image_id + ".jpg")))
+            bboxes.append(np.array(image_boxes, np.float32))
+            labels.append(np.array(image_labels, np.int32))
+
+        return paths, bboxes, labels, class_names
+
+    def write_index(self, class_names: List[str]):
+        if self.annotation_format == "coco":
+            paths, bboxes, labels, class_names = self.parse_coco(class_names)
+        elif self.annotation_format == "voc":
+            paths, bboxes, labels, class_names = self.parse_voc(class_names)
+        else:
+            raise ValueError("Unknown annotation format: {}".format(self.annotation_format))
+
+        # flat arrays plus offsets, record i owns [offsets[i], offsets[i + 1])
+        encoded_paths = [path.encode("utf-8") for path in paths]
+        index = {
+            "paths": np.frombuffer(b"".join(encoded_paths), np.uint8),
+            "path_offsets": np.cumsum([0] + [len(path) for path in encoded_paths], dtype=np.int64),
+            "bbox": np.concatenate(bboxes).astype(np.float32) if bboxes else np.zeros((0, 4), np.float32),
+            "label": np.concatenate(labels).astype(np.int32) if labels else np.zeros((0,), np.int32),
+            "bbox_offsets": np.cumsum([0] + [len(bbox) for bbox in bboxes], dtype=np.int64)
+        }
+
+        # write into a temporary directory so a partial index is never picked up
+        tmp_path = self.index_path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name in INDEX_FILES:
+            np.save(os.path.join(tmp_path, name + ".npy"), index[name])
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"num_of_img": len(paths), "class_names": class_names,
+                       "annotations": os.path.abspath(self.annotation_path)}, f)
+        os.replace(tmp_path, self.index_path)
+        print("Indexed {} images to {}".format(len(paths), self.index_path))
+
+    def load_index(self) -> Tuple[Dict[str, np.ndarray], Dict]:
+        index = {name: np.load(os.path.join(self.index_path, name + ".npy"), mmap_mode="r") for name in INDEX_FILES}
+        with open(os.path.join(self.index_path, "meta.json")) as f:
+            meta = json.load(f)
+
+        return index, meta
+
+    def load_dataset(self, dataset: str, mode: Any) -> tf.data.Dataset:
+        # the index is loaded into tensors once, so the per record lookup is a graph slice without python
+        path_offsets = self.index["path_offsets"]
+        paths = tf.constant([self.index["paths"][path_offsets[i]:path_offsets[i + 1]].tobytes()
+                             for i in range(self.num_of_img)], tf.string)
+        bbox = tf.constant(self.index["bbox"], tf.float32)
+        label = tf.constant(self.index["label"], tf.int32)
+        bbox_offsets = tf.constant(self.index["bbox_offsets"], tf.int64)
+
+        def map_record_func(i: tf.Tensor) -> Dict:
+            # record i owns the boxes [bbox_offsets[i], bbox_offsets[i + 1])
+            begin, end = bbox_offsets[i], bbox_offsets[i + 1]
+            return {"image_path": paths[i], "bbox": bbox[begin:end], "label": label[begin:end]}
+
+        # shuffling record indices is cheap, the buffer in get_dataset then only mixes neighbours
+        return tf.data.Dataset.range(self.num_of_img) \
+            .shuffle(self.num_of_img, reshuffle_each_iteration=True) \
+            .map(map_record_func, num_parallel_calls=self.num_parallel_calls)
+
+    def get_bbox_and_label(self, feature: Dict) -> Tuple[tf.Tensor, tf.Tensor]:
+        return feature["bbox"], feature["label"]
+
+    def decode_image(self, feature: Dict) -> tf.Tensor:
+        # read and decode happen in the parallel map of get_dataset
+        image = tf.io.read_file(feature["image_path"])
+        return tf.io.decode_image(image, channels=3, expand_animations=False)
+
+    def augment_image(self, image: tf.Tensor) -> tf.Tensor:
+        img = random_brightness(image, max_delta=0.25)
+        img = random_contrast(img, lower=0.4, upper=1.3)
+        img = random_hue(img, max_delta=0.2)
+        img = random_saturation(img, lower=0, upper=4)
+
+        return img
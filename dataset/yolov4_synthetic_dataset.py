@@ -0,0 +1,129 @@
+import hashlib
+import json
+from typing import Dict, Tuple, Any, List
+
+import tensorflow as tf
+import tensorflow_datasets as tfds
+
+from config import cfg
+from dataset.yolov4_dataset import YOLOv4Dataset
+from utils.augmentation import random_brightness, random_contrast, random_hue, random_saturation
+
+
+class SyntheticDataset(YOLOv4Dataset):
+    # procedural images and boxes, deterministic per (seed, split, index), no download needed
+    def __init__(
+            self,
+            dataset: str = "synthetic",
+            mode: Any = tfds.Split.TRAIN,
+            image_size: int = cfg.image_size,
+            batch_size: int = cfg.batch_size,
+            buffer_size: int = cfg.buffer_size,
+            prefetch_size: int = cfg.prefetch_size,
+            num_of_img: int = cfg.synthetic_num_of_img,
+            num_class: int = cfg.synthetic_num_class,
+            max_bbox_per_image: int = cfg.synthetic_max_bbox_per_image,
+            original_image_sizes: List[Tuple[int, int]] = cfg.synthetic_image_sizes,
+            seed: int = cfg.synthetic_seed,
+            **kwargs
+    ):
+        # load_dataset and get_cache_key are called by the base class, so set everything they need first
+        self.num_of_img = num_of_img if mode == tfds.Split.TRAIN else max(num_of_img // 10, 1)
+        self.num_class = num_class
+        self.max_bbox_per_image = max_bbox_per_image
+        self.original_image_sizes = [tuple(size) for size in original_image_sizes]
+        self.seed = seed * 2 + (0 if mode == tfds.Split.TRAIN else 1)
+        super(SyntheticDataset, self).__init__(dataset=dataset, mode=mode, image_size=image_size,
+                                               batch_size=batch_size, buffer_size=buffer_size,
+                                               prefetch_size=prefetch_size, **kwargs)
+
+    def get_cache_key(self, dataset: str, mode: Any) -> str:
+        key = json.dumps({
+            "num_of_img": self.num_of_img,
+            "num_class": self.num_class,
+            "max_bbox_per_image": self.max_bbox_per_image,
+            "original_image_sizes": self.original_image_sizes,
+            "seed": self.seed,
+            "image_shapes": self.image_shapes,
+            "anchors": cfg.anchors.yolo_anchors.tolist(),
+            "anchor_masks": self.anchor_masks.tolist()
+        }, sort_keys=True)
+        key = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+        return "{}_{}_{}".format(dataset, mode, key)
+
+    def load_dataset(self, dataset: str, mode: Any) -> tf.data.Dataset:
+        # records only hold the boxes, images are drawn in decode_image after filter and shuffle
+        return tf.data.Dataset.range(self.num_of_img).map(self.generate_record,
+                                                          num_parallel_calls=self.num_parallel_calls)
+
+    def random_seed(self, index: tf.Tensor, stream: int) -> tf.Tensor:
+        return tf.stack([tf.constant(self.seed * 16 + stream, tf.int64), index])
+
+    def generate_record(self, index: tf.Tensor) -> Dict:
+        index = tf.cast(index, tf.int64)
+        image_sizes = tf.constant(self.original_image_sizes, tf.int32)
+        original_image_size = tf.gather(image_sizes, index % len(self.original_image_sizes))
+
+        num_of_bbox = tf.random.stateless_uniform([], self.random_seed(index, 0), minval=1,
+                                                  maxval=self.max_bbox_per_image + 1, dtype=tf.int32)
+
+        # box size is log-uniform between 2% and 50% of the image, aspect ratio between 1:3 and 3:1
+        scale = tf.exp(tf.random.stateless_uniform([num_of_bbox], self.random_seed(index, 1),
+                                                   minval=tf.math.log(0.02), maxval=tf.math.log(0.5)))
+        ratio = tf.exp(tf.random.stateless_uniform([num_of_bbox], self.random_seed(index, 2),
+                                                   minval=tf.math.log(1 / 3), maxval=tf.math.log(3.)))
+        height = tf.minimum(scale * tf.sqrt(ratio), 1.)
+        width = tf.minimum(scale / tf.sqrt(ratio), 1.)
+        y_min = tf.random.stateless_uniform([num_of_bbox], self.random_seed(index, 3)) * (1 - height)
+        x_min = tf.random.stateless_uniform([num_of_bbox], self.random_seed(index, 4)) * (1 - width)
+
+        label = tf.random.stateless_uniform([num_of_bbox], self.random_seed(index, 5), minval=0,
+                                            maxval=self.num_class, dtype=tf.int32)
+
+        return {
+            "index": index,
+            "image_size": original_image_size,
+            "bbox": tf.stack([y_min, x_min, y_min + height, x_min + width], axis=-1),
+            "label": label
+        }
+
+    def get_bbox_and_label(self, feature: Dict) -> Tuple[tf.Tensor, tf.Tensor]:
+        return feature["bbox"], feature["label"]
+
+    def decode_image(self, feature: Dict) -> tf.Tensor:
+        # noisy gradient background with one filled rectangle per box, coloured by class
+        index = feature["index"]
+        image_h, image_w = feature["image_size"][0], feature["image_size"][1]
+        bbox, label = self.get_bbox_and_label(feature)
+
+        y = tf.linspace(0., 1., image_h)[:, tf.newaxis, tf.newaxis]
+        x = tf.linspace(0., 1., image_w)[tf.newaxis, :, tf.newaxis]
+        corners = tf.random.stateless_uniform([3, 3], self.random_seed(index, 6), maxval=255.)
+        background = corners[0] + (corners[1] - corners[0]) * y + (corners[2] - corners[0]) * x / 2
+        background += tf.random.stateless_uniform([image_h, image_w, 3], self.random_seed(index, 7), minval=-20,
+                                                  maxval=20)
+
+        hue = tf.cast(label, tf.float32) / self.num_class
+        hsv = tf.stack([hue, tf.ones_like(hue), tf.ones_like(hue)], axis=-1)
+        colors = tf.image.hsv_to_rgb(hsv) * 255.
+
+        # mask.shape = (n, h, w), later boxes are drawn on top
+        y_min, x_min, y_max, x_max = [coor[:, tf.newaxis, tf.newaxis] for coor in tf.unstack(bbox, axis=-1)]
+        y, x = y[tf.newaxis, ..., 0], x[tf.newaxis, ..., 0]
+        mask = (y >= y_min) & (y <= y_max) & (x >= x_min) & (x <= x_max)
+        box_index = tf.range(1, tf.shape(bbox)[0] + 1)[:, tf.newaxis, tf.newaxis]
+        top = tf.reduce_max(tf.where(mask, box_index, tf.zeros_like(box_index)), axis=0)
+        foreground = tf.gather(tf.concat([tf.zeros([1, 3]), colors], axis=0), top)
+
+        image = tf.where(top[..., tf.newaxis] > 0, foreground, background)
+
+        return tf.saturate_cast(tf.round(image), tf.uint8)
+
+    def augment_image(self, image: tf.Tensor) -> tf.Tensor:
+        img = random_brightness(image, max_delta=0.25)
+        img = random_contrast(img, lower=0.4, upper=1.3)
+        img = random_hue(img, max_delta=0.2)
+        img = random_saturation(img, lower=0, upper=4)
+
+        return img
@@ -0,0 +1,62 @@
+import argparse
+import os
+
+import tensorflow as tf
+
+from config import cfg
+from dataset.coco_classes import coco_classes
+from dataset.wider_face_classes import wider_face_classes
+from model.inference import YOLOv4Inference
+from model.nms import NMS_ENGINES
+from model.optimize import optimize_for_inference
+from model.yolov4 import YOLOv4
+
+
+def get_num_class(dataset: str, num_class: int) -> int:
+    if num_class is not None:
+        return num_class
+    if dataset == "coco":
+        return len(coco_classes)
+    elif dataset == "wider_face":
+        return len(wider_face_classes)
+    elif dataset == "synthetic":
+        return cfg.synthetic_num_class
+    else:
+        print("Number of classes of {} dataset is unknown, set it with --num_class".format(dataset))
+        exit(1)
+
+
+def load_model(num_class: int, image_size: int, checkpoint_dir: str) -> tf.keras.Model:
+    model = YOLOv4(num_class=num_class)
+    model(tf.zeros((1, image_size, image_size, 3)))
+
+    # only the network weights of the training checkpoint are needed
+    latest_checkpoint = tf.train.latest_checkpoint(checkpoint_dir)
+    if latest_checkpoint is None:
+        print("No checkpoint found in {}".format(checkpoint_dir))
+        exit(1)
+    tf.train.Checkpoint(net=model).restore(latest_checkpoint).expect_partial()
+    print("Restored from {}".format(latest_checkpoint))
+
+    return model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a SavedModel with letterbox, YOLOv4, decode and NMS in one graph')
+    parser.add_argument('-d', '--dataset', type=str, default=cfg.dataset, help='Dataset name, coco, wider_face, synthetic or local')
+    parser.add_argument('-c', '--num_class', type=int, default=None, help='Number of classes, required for local')
+    parser.add_argument('-i', '--image_size', type=int, default=cfg.image_size, help='Reshape size of the image')
+    parser.add_argument('-k', '--checkpoint_dir', type=str, default='./checkpoints/yolov4_train.tf', help='Training checkpoint directory')
+    parser.add_argument('-e', '--engine', type=str, default=cfg.nms_engine, choices=list(NMS_ENGINES), help='NMS engine')
+    parser.add_argument('-n', '--no_optimize', action='store_true', help='Keep batchnorm and dropblock layers')
+    parser.add_argument('-o', '--output', type=str, default='./saved_model/yolov4', help='SavedModel directory')
+    args = parser.parse_args()
+
+    model = load_model(get_num_class(args.dataset, args.num_class), args.image_size, args.checkpoint_dir)
+    if not args.no_optimize:
+        # fold batchnorm into the convs and drop the dropblock layers
+        model = optimize_for_inference(model, args.image_size)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    YOLOv4Inference(model, image_size=args.image_size, engine=args.engine).save(args.output)
+    print("Exported to {}".format(args.output))
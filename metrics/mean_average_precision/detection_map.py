@@ -59,6 +59,23 @@ class DetectionMAP:
                 print("Evaluate pr_scale {}".format(r))
             self.evaluate_(IoUmask, accumulators, pred_classes, pred_conf, gt_classes, r)
 
+    def evaluate_batch(self, pred_bb, pred_classes, pred_conf, valid_detections, gt):
+        """
+        Update the accumulator for a batch of padded predictions and variable length ground truths.
+        :param pred_bb: (np.array)          Predicted Bounding Boxes [x1, y1, x2, y2] :     Shape [batch, max_pred, 4]
+        :param pred_classes: (np.array)     Predicted Classes :                             Shape [batch, max_pred]
+        :param pred_conf: (np.array)        Predicted Confidences [0.-1.] :                 Shape [batch, max_pred]
+        :param valid_detections: (np.array) Number of valid predictions per image :         Shape [batch]
+        :param gt: (iterable)               Ground Truths [x1, y1, x2, y2, class] per image,
+                                            e.g. a tf.RaggedTensor :                        Shape [batch, (n_gt), 5]
+        :return:
+        """
+        for frame in zip(pred_bb, pred_classes, pred_conf, valid_detections, gt):
+            bb, classes, conf, valid_detection, gt_box = frame
+            gt_box = np.asarray(gt_box).reshape(-1, 5)
+            self.evaluate(bb[:valid_detection], classes[:valid_detection], conf[:valid_detection],
+                          gt_box[:, :4], gt_box[:, 4])
+
     @staticmethod
     def evaluate_(IoUmask, accumulators, pred_classes, pred_conf, gt_classes, confidence_threshold):
         pred_classes = pred_classes.astype(np.int)
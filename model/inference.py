@@ -0,0 +1,87 @@
+from typing import Dict, Tuple
+
+import tensorflow as tf
+
+from config import cfg
+from model.utils import non_max_suppression
+
+
+def letterbox_image(image: tf.Tensor, image_size: int) -> Tuple[tf.Tensor, tf.Tensor]:
+    # same letterbox as YOLOv4Dataset: keep the aspect ratio, pad at the bottom and right
+    # return the padded image and the ratio between the original and the letterboxed image
+    original_image_size = tf.cast(tf.shape(image)[0:2], tf.float32)
+    ratio = tf.reduce_min(image_size / original_image_size)
+    img = tf.image.resize(image, (image_size, image_size), preserve_aspect_ratio=True)
+    img = tf.image.pad_to_bounding_box(img, 0, 0, image_size, image_size)
+
+    return img, ratio
+
+
+class YOLOv4Inference(tf.Module):
+    def __init__(
+            self,
+            model: tf.keras.Model,
+            image_size: int = cfg.image_size,
+            iou_threshold: float = cfg.yolo_iou_threshold,
+            score_threshold: float = cfg.yolo_score_threshold,
+            max_bbox_size: int = cfg.max_bbox_size,
+            engine: str = cfg.nms_engine,
+            name: str = "yolov4_inference"):
+        # letterbox, network, decode and nms in one graph, boxes are returned in original image pixels
+        super(YOLOv4Inference, self).__init__(name=name)
+        self.model = model
+        self.image_size = image_size
+        self.iou_threshold = iou_threshold
+        self.score_threshold = score_threshold
+        self.max_bbox_size = max_bbox_size
+        self.engine = engine
+
+    def detect(self, images: tf.Tensor, ratios: tf.Tensor, original_image_sizes: tf.Tensor) -> Dict[str, tf.Tensor]:
+        # images: (batch_size, image_size, image_size, 3) letterboxed in [0, 255]
+        # ratios: (batch_size) letterbox ratio, original_image_sizes: (batch_size, (h, w))
+        x = images / 127.5 - 1  # normalize to [-1, 1]
+        pred = self.model(x, training=False)
+        bboxes, scores, classes, valid_detections = non_max_suppression(
+            pred, iou_threshold=self.iou_threshold, score_threshold=self.score_threshold,
+            max_bbox_size=self.max_bbox_size, engine=self.engine)
+
+        # normalized letterbox coordinates => original image pixels
+        bboxes = bboxes * self.image_size / ratios[:, tf.newaxis, tf.newaxis]
+        original_image_sizes = tf.cast(original_image_sizes, tf.float32)
+        max_xy = tf.tile(tf.reverse(original_image_sizes, axis=[-1]), (1, 2))[:, tf.newaxis]
+        bboxes = tf.clip_by_value(bboxes, 0.0, max_xy)
+
+        return {
+            "bboxes": bboxes,  # (batch_size, max_bbox_size, (x1, y1, x2, y2))
+            "scores": scores,
+            "classes": tf.cast(classes, tf.int32),
+            "valid_detections": valid_detections
+        }
+
+    @tf.function(input_signature=[tf.TensorSpec((None, None, None, 3), tf.uint8)])
+    def serve_images(self, images: tf.Tensor) -> Dict[str, tf.Tensor]:
+        # a batch of decoded images of the same size
+        img, ratio = tf.map_fn(lambda image: letterbox_image(image, self.image_size), images,
+                               fn_output_signature=(tf.float32, tf.float32))
+        original_image_sizes = tf.tile(tf.shape(images)[tf.newaxis, 1:3], (tf.shape(images)[0], 1))
+
+        return self.detect(img, ratio, original_image_sizes)
+
+    @tf.function(input_signature=[tf.TensorSpec((None,), tf.string)])
+    def serve_encoded(self, encoded_images: tf.Tensor) -> Dict[str, tf.Tensor]:
+        # a batch of encoded jpeg, png, bmp or gif images of any size
+        def decode(encoded_image):
+            image = tf.io.decode_image(encoded_image, channels=3, expand_animations=False)
+            img, ratio = letterbox_image(image, self.image_size)
+            return img, ratio, tf.shape(image)[0:2]
+
+        img, ratio, original_image_sizes = tf.map_fn(decode, encoded_images,
+                                                     fn_output_signature=(tf.float32, tf.float32, tf.int32))
+
+        return self.detect(img, ratio, original_image_sizes)
+
+    def save(self, export_dir: str):
+        tf.saved_model.save(self, export_dir, signatures={
+            "serving_default": self.serve_images,
+            "serve_encoded": self.serve_encoded
+        })
@@ -6,6 +6,8 @@ from tensorflow.keras import backend as K
 from tensorflow.keras.layers import Layer, Conv2D, LeakyReLU, Concatenate, MaxPool2D, UpSampling2D, \
     Activation, ReLU, BatchNormalization
 
+from config import cfg
+
 
 class DropBlock(Layer):
     def __init__(self, keep_prob, block_size, name="dropblock", **kwargs):
@@ -17,7 +19,6 @@ class DropBlock(Layer):
         return input_shape
 
     def build(self, input_shape):
-        _, self.h, self.w, self.channel = input_shape.as_list()
         # pad the mask
         bottom = right = (self.block_size - 1) // 2
         top = left = (self.block_size - 1) - bottom
@@ -45,16 +46,20 @@ class DropBlock(Layer):
         """This method only supports Eager Execution"""
         if keep_prob is not None:
             self.keep_prob = keep_prob
-        w, h = tf.cast(self.w, tf.float32), tf.cast(self.h, tf.float32)
-        self.gamma = (1. - self.keep_prob) * (w * h) / (self.block_size ** 2) / \
-                     ((w - self.block_size + 1) * (h - self.block_size + 1))
+
+    def _gamma(self, h, w):
+        # h, w are taken from the input on every call, so the input size can change between calls
+        w, h = tf.cast(w, tf.float32), tf.cast(h, tf.float32)
+        return (1. - self.keep_prob) * (w * h) / (self.block_size ** 2) / \
+               ((w - self.block_size + 1) * (h - self.block_size + 1))
 
     def _create_mask(self, input_shape):
+        h, w = input_shape[1], input_shape[2]
         sampling_mask_shape = tf.stack([input_shape[0],
-                                        self.h - self.block_size + 1,
-                                        self.w - self.block_size + 1,
-                                        self.channel])
-        mask = DropBlock._bernoulli(sampling_mask_shape, self.gamma)
+                                        h - self.block_size + 1,
+                                        w - self.block_size + 1,
+                                        input_shape[3]])
+        mask = DropBlock._bernoulli(sampling_mask_shape, self._gamma(h, w))
         mask = tf.pad(mask, self.padding)
         mask = tf.nn.max_pool(mask, [1, self.block_size, self.block_size, 1], [1, 1, 1, 1], 'SAME')
         mask = 1 - mask
@@ -86,6 +91,16 @@ def create_activation_layer(name: str) -> Union[Mish, LeakyReLU, ReLU, Activatio
         return Activation("linear", dtype=tf.float32, name="Output-float32-casting")
 
 
+def create_batch_norm_layer(synchronized: bool = False) -> BatchNormalization:
+    if not synchronized:
+        return BatchNormalization()
+
+    # the batch mean and variance are all-reduced over the replicas
+    if hasattr(tf.keras.layers, "experimental") and hasattr(tf.keras.layers.experimental, "SyncBatchNormalization"):
+        return tf.keras.layers.experimental.SyncBatchNormalization()
+    return BatchNormalization(synchronized=True)
+
+
 class MyConv2D(Layer):
     def __init__(
             self,
@@ -99,9 +114,13 @@ class MyConv2D(Layer):
             apply_dropblock: bool = False,
             keep_prob: float = 0.8,
             dropblock_size: int = 3,
+            sync_batchnorm: Union[None, bool] = None,
             name: str = "conv2d",
             **kwargs):
         super(MyConv2D, self).__init__(name=name, **kwargs)
+        # by default sync batchnorm when the layer is created in the scope of a multi replica strategy
+        if sync_batchnorm is None:
+            sync_batchnorm = cfg.sync_batch_norm and tf.distribute.get_strategy().num_replicas_in_sync > 1
         self.conv2d = Conv2D(
             filters,
             kernel_size,
@@ -116,9 +135,36 @@ class MyConv2D(Layer):
         self.apply_activation = activation is not None
         self.apply_batchnorm = apply_batchnorm
         self.apply_dropblock = apply_dropblock
-        self.batch_norm = BatchNormalization()
+        self.batch_norm = create_batch_norm_layer(synchronized=sync_batchnorm)
         self.drop_block = DropBlock(keep_prob=keep_prob, block_size=dropblock_size)
 
+    def fuse(self):
+        # inference only: fold the batchnorm moving statistics into the conv kernel and bias,
+        # drop the dropblock and an identity activation, the fused layer must not be trained any more
+        if self.apply_batchnorm:
+            kernel = self.conv2d.kernel
+            scale = self.batch_norm.gamma * tf.math.rsqrt(self.batch_norm.moving_variance + self.batch_norm.epsilon)
+            bias = self.batch_norm.beta - self.batch_norm.moving_mean * scale
+
+            conv2d = Conv2D(
+                self.conv2d.filters,
+                self.conv2d.kernel_size,
+                self.conv2d.strides,
+                dilation_rate=self.conv2d.dilation_rate,
+                padding=self.conv2d.padding,
+                use_bias=True
+            )
+            conv2d.build((None, None, None, kernel.shape[2]))
+            conv2d.set_weights([kernel * scale, bias])
+            self.conv2d = conv2d
+            self.apply_batchnorm = False
+
+        if isinstance(self.activation, Activation) and self.activation.activation is tf.keras.activations.linear:
+            self.apply_activation = False
+        self.apply_dropblock = False
+        self.batch_norm = None
+        self.drop_block = None
+
     def call(self, inputs: tf.Tensor, training: bool = False, **kwargs) -> tf.Tensor:
         x = self.conv2d(inputs, training=training)
         if self.apply_batchnorm:
@@ -1,13 +1,17 @@
-from typing import Union, Tuple
+from typing import Union, Tuple, Dict, List, Callable
 
 import numpy as np
 import tensorflow as tf
 from tensorflow.keras.losses import Loss, binary_crossentropy
 
 from config import cfg
+from model.utils import encode_label, get_output_decode_table, DecodeTable
 
 
 class YOLOv4Loss(Loss):
+    scale_names = ("sbbox", "mbbox", "lbbox")
+    component_names = ("box", "confidence", "class")
+
     def __init__(
             self,
             num_class: int,
@@ -16,8 +20,12 @@ class YOLOv4Loss(Loss):
             use_focal_loss: bool = False,
             use_focal_obj_loss: bool = False,
             use_giou_loss: bool = False,
-            use_ciou_loss: bool = False):
-        super(YOLOv4Loss, self).__init__()
+            use_ciou_loss: bool = False,
+            static_shape: bool = False,
+            max_bbox_size: int = cfg.max_bbox_size,
+            from_logits: bool = False):
+        # the loss is already summed, SUM keeps it unscaled inside a tf.distribute replica
+        super(YOLOv4Loss, self).__init__(reduction="sum")
         self.num_class = num_class
         self.yolo_iou_threshold = yolo_iou_threshold
         self.label_smoothing_factor = label_smoothing_factor
@@ -25,24 +33,28 @@ class YOLOv4Loss(Loss):
         self.use_focal_loss = use_focal_loss
         self.use_giou_loss = use_giou_loss
         self.use_ciou_loss = use_ciou_loss
-        self.anchors = cfg.anchors.get_anchors()
+        # static_shape masks instead of gathering, so the loss compiles with XLA
+        self.static_shape = static_shape
+        self.max_bbox_size = max_bbox_size
+        # from_logits computes objectness, class and focal terms on the raw outputs, skipping the sigmoid
+        self.from_logits = from_logits
         self.anchor_masks = cfg.anchors.get_anchor_masks()
 
     @staticmethod
-    def decode_loss(pred: tf.Tensor, anchors: np.ndarray) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]:
-        # pred: (batch_size, grid, grid, anchors, (x, y, w, h, obj, ...classes))
-        grid_size = tf.shape(pred)[1]
+    def decode_loss(pred: tf.Tensor, anchors: tf.Tensor, grid: tf.Tensor, grid_scale: tf.Tensor,
+                    from_logits: bool = False) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]:
+        # pred: (batch_size, grid_y, grid_x, anchors, (x, y, w, h, obj, ...classes))
+        # anchors, grid and grid_scale of the output scale come from its DecodeTable
+        # from_logits returns the objectness and class logits instead of probabilities
         box_xy, box_wh, objectness, class_probs = tf.split(pred, (2, 2, 1, -1), axis=-1)
 
         box_xy = cfg.grid_sensitivity_ratio * tf.sigmoid(box_xy)
-        objectness = tf.sigmoid(objectness)
-        class_probs = tf.sigmoid(class_probs)
+        if not from_logits:
+            objectness = tf.sigmoid(objectness)
+            class_probs = tf.sigmoid(class_probs)
         raw_box = tf.concat([box_xy, box_wh], axis=-1)
 
-        grid = tf.meshgrid(tf.range(grid_size), tf.range(grid_size))
-        grid = tf.expand_dims(tf.stack(grid, axis=-1), axis=2)
-
-        box_xy = (box_xy + tf.cast(grid, tf.float32)) / tf.cast(grid_size, tf.float32)
+        box_xy = (box_xy + grid) / grid_scale
         box_wh = tf.exp(box_wh) * anchors
 
         box_x1y1 = box_xy - box_wh / 2
@@ -82,6 +94,27 @@ class YOLOv4Loss(Loss):
         iou = tf.math.divide_no_nan(int_area, (box_1_area + box_2_area - int_area))
         return iou
 
+    @staticmethod
+    def batch_iou(box_1: tf.Tensor, box_2: tf.Tensor) -> tf.Tensor:
+        # box_1: (batch_size, grid_y, grid_x, anchors, (x1, y1, x2, y2))
+        # box_2: (batch_size, N, (x1, y1, x2, y2))
+        # return: (batch_size, grid_y, grid_x, anchors, N)
+        box_1 = box_1[..., tf.newaxis, :]
+        box_2 = box_2[:, tf.newaxis, tf.newaxis, tf.newaxis]
+
+        int_w = tf.maximum(tf.minimum(box_1[..., 2], box_2[..., 2]) -
+                           tf.maximum(box_1[..., 0], box_2[..., 0]), 0)
+        int_h = tf.maximum(tf.minimum(box_1[..., 3], box_2[..., 3]) -
+                           tf.maximum(box_1[..., 1], box_2[..., 1]), 0)
+        int_area = int_w * int_h
+        box_1_area = (box_1[..., 2] - box_1[..., 0]) * \
+                     (box_1[..., 3] - box_1[..., 1])
+        box_2_area = (box_2[..., 2] - box_2[..., 0]) * \
+                     (box_2[..., 3] - box_2[..., 1])
+
+        iou = tf.math.divide_no_nan(int_area, (box_1_area + box_2_area - int_area))
+        return iou
+
     @staticmethod
     def iou(box_1: tf.Tensor, box_2: tf.Tensor) -> tf.Tensor:
         # box_1: (..., (x1, y1, x2, y2))
@@ -101,8 +134,8 @@ class YOLOv4Loss(Loss):
 
     @staticmethod
     def giou(box_1: tf.Tensor, box_2: tf.Tensor) -> tf.Tensor:
-        # box_1: (batch_size, grid_y, grid_x, N, (x1, y1, x2, y2))
-        # box_2: (batch_size, grid_y, grid_x, N, (x1, y1, x2, y2))
+        # box_1: (..., (x1, y1, x2, y2)), e.g. the gathered positive cells
+        # box_2: (..., (x1, y1, x2, y2))
         int_w = tf.maximum(tf.minimum(box_1[..., 2], box_2[..., 2]) -
                            tf.maximum(box_1[..., 0], box_2[..., 0]), 0)
         int_h = tf.maximum(tf.minimum(box_1[..., 3], box_2[..., 3]) -
@@ -125,8 +158,8 @@ class YOLOv4Loss(Loss):
 
     @staticmethod
     def ciou(box_1: tf.Tensor, box_2: tf.Tensor) -> tf.Tensor:
-        # box_1: (batch_size, grid_y, grid_x, N, (x1, y1, x2, y2))
-        # box_2: (batch_size, grid_y, grid_x, N, (x1, y1, x2, y2))
+        # box_1: (..., (x1, y1, x2, y2)), e.g. the gathered positive cells
+        # box_2: (..., (x1, y1, x2, y2))
 
         # box area
         box_1_w, box_1_h = box_1[..., 2] - box_1[..., 0], box_1[..., 3] - box_1[..., 1]
@@ -167,11 +200,22 @@ class YOLOv4Loss(Loss):
 
         return ciou
 
+    def binary_crossentropy(self, y_true: tf.Tensor, y_pred: tf.Tensor,
+                            label_smoothing: Union[tf.Tensor, float] = 0) -> tf.Tensor:
+        # mean over the last axis like keras binary_crossentropy, y_pred are logits when from_logits is set
+        if not self.from_logits:
+            return binary_crossentropy(y_true, y_pred, label_smoothing=label_smoothing)
+
+        y_true = y_true * (1.0 - label_smoothing) + 0.5 * label_smoothing
+        return tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=y_true, logits=y_pred), axis=-1)
+
     def focal_loss(self, y_true: tf.Tensor, y_pred: tf.Tensor, gamma: Union[tf.Tensor, float] = 2.0,
                    alpha: Union[tf.Tensor, float] = 0.25, label_smoothing: Union[tf.Tensor, float] = 0) -> tf.Tensor:
-        sigmoid_loss = binary_crossentropy(y_true, y_pred, label_smoothing=label_smoothing)
+        sigmoid_loss = self.binary_crossentropy(y_true, y_pred, label_smoothing=label_smoothing)
         sigmoid_loss = tf.expand_dims(sigmoid_loss, axis=-1)
 
+        if self.from_logits:
+            y_pred = tf.sigmoid(y_pred)
         p_t = ((y_true * y_pred) + ((1 - y_true) * (1 - y_pred)))
         modulating_factor = tf.pow(1.0 - p_t, gamma)
         alpha_weight_factor = (y_true * alpha + (1 - y_true) * (1 - alpha))
@@ -182,11 +226,69 @@ class YOLOv4Loss(Loss):
 
         return sigmoid_focal_loss
 
-    def loss_layer(self, y_pred: tf.Tensor, y_true: tf.Tensor, anchors: np.array) -> tf.Tensor:
+    def get_best_iou(self, pred_box_coor: tf.Tensor, true_box_coor: tf.Tensor, obj_mask: tf.Tensor,
+                     true_bbox: tf.Tensor = None, valid: tf.Tensor = None) -> tf.Tensor:
+        # best iou of every predicted box with the true boxes of its image
+        if true_bbox is not None:
+            # all images against their padded true boxes in one op, padded boxes are masked out of the max
+            iou = YOLOv4Loss.batch_iou(pred_box_coor, true_bbox)
+            iou = tf.where(valid[:, tf.newaxis, tf.newaxis, tf.newaxis], iou, tf.zeros_like(iou))
+            return tf.reduce_max(iou, axis=-1)
+
+        if not self.static_shape:
+            best_iou, _, _ = tf.map_fn(
+                lambda x: (tf.reduce_max(YOLOv4Loss.broadcast_iou(x[0], tf.boolean_mask(
+                    x[1], tf.cast(x[2], tf.bool))), axis=-1), 0, 0),
+                (pred_box_coor, true_box_coor, obj_mask))
+            return best_iou
+
+        # take a fixed number of positive cells per image, empty slots are masked out of the max
+        batch_size = tf.shape(obj_mask)[0]
+        true_box_coor = tf.reshape(true_box_coor, (batch_size, -1, 4))
+        obj_mask = tf.reshape(obj_mask, (batch_size, -1))
+        num_of_cell = obj_mask.shape[1]
+        k = min(self.max_bbox_size, num_of_cell) if num_of_cell is not None else \
+            tf.minimum(self.max_bbox_size, tf.shape(obj_mask)[1])
+        obj_value, index = tf.math.top_k(obj_mask, k=k)
+        true_box_coor = tf.gather(true_box_coor, index, batch_dims=1)
+
+        iou = YOLOv4Loss.batch_iou(pred_box_coor, true_box_coor)
+        iou = tf.where(obj_value[:, tf.newaxis, tf.newaxis, tf.newaxis] > 0, iou, tf.zeros_like(iou))
+        return tf.reduce_max(iou, axis=-1)
+
+    def positive_box_loss(self, pred_box_coor: tf.Tensor, true_box_coor: tf.Tensor, obj_mask: tf.Tensor,
+                          box_loss_scale: tf.Tensor, iou_fn: Callable[[tf.Tensor, tf.Tensor], tf.Tensor]) -> tf.Tensor:
+        # iou family box loss of the positive cells only, summed per image => (batch_size)
+        batch_size = tf.shape(obj_mask)[0]
+        if self.static_shape:
+            # a fixed number of cells per image, empty slots get a zero weight
+            pred_box_coor = tf.reshape(pred_box_coor, (batch_size, -1, 4))
+            true_box_coor = tf.reshape(true_box_coor, (batch_size, -1, 4))
+            box_loss_scale = tf.reshape(box_loss_scale, (batch_size, -1))
+            obj_mask = tf.reshape(obj_mask, (batch_size, -1))
+            num_of_cell = obj_mask.shape[1]
+            k = min(self.max_bbox_size, num_of_cell) if num_of_cell is not None else \
+                tf.minimum(self.max_bbox_size, tf.shape(obj_mask)[1])
+            obj_value, index = tf.math.top_k(obj_mask, k=k)
+
+            iou = iou_fn(tf.gather(pred_box_coor, index, batch_dims=1), tf.gather(true_box_coor, index, batch_dims=1))
+            box_loss = obj_value * tf.gather(box_loss_scale, index, batch_dims=1) * (1 - iou)
+            return tf.reduce_sum(box_loss, axis=-1)
+
+        # (n, (batch, grid_y, grid_x, anchor)) of the positive cells
+        index = tf.where(obj_mask > 0)
+        iou = iou_fn(tf.gather_nd(pred_box_coor, index), tf.gather_nd(true_box_coor, index))
+        box_loss = tf.gather_nd(obj_mask * box_loss_scale, index) * (1 - iou)
+
+        return tf.math.unsorted_segment_sum(box_loss, tf.cast(index[:, 0], tf.int32), num_segments=batch_size)
+
+    def loss_layer(self, y_pred: tf.Tensor, y_true: tf.Tensor, anchors: tf.Tensor, grid: tf.Tensor,
+                   grid_scale: tf.Tensor, true_bbox: tf.Tensor = None, valid: tf.Tensor = None) -> Dict[str, tf.Tensor]:
         # 1. transform all pred outputs
         # y_pred: (batch_size, grid, grid, anchors, (x, y, w, h, obj, ...class))
         # pred_box_coor: (batch_size, grid, grid, anchors, (x1, y1, x2, y2))
-        pred_box_coor, pred_obj, pred_class, pred_raw_box = YOLOv4Loss.decode_loss(y_pred, anchors)
+        pred_box_coor, pred_obj, pred_class, pred_raw_box = YOLOv4Loss.decode_loss(
+            y_pred, anchors, grid, grid_scale, from_logits=self.from_logits)
 
         # 2. transform all true outputs
         # y_true: (batch_size, grid, grid, anchors, (x, y, w, h, obj, ...class))
@@ -207,11 +309,7 @@ class YOLOv4Loss(Loss):
         # 3. calculate all masks
         obj_mask = tf.squeeze(true_obj, -1)
         # ignore false positive when iou is over threshold
-        best_iou, _, _ = tf.map_fn(
-            lambda x: (tf.reduce_max(YOLOv4Loss.broadcast_iou(x[0], tf.boolean_mask(
-                x[1], tf.cast(x[2], tf.bool))), axis=-1), 0, 0),
-            (pred_box_coor, true_box_coor, obj_mask))
-
+        best_iou = self.get_best_iou(pred_box_coor, true_box_coor, obj_mask, true_bbox=true_bbox, valid=valid)
         ignore_mask = tf.cast(best_iou < self.yolo_iou_threshold, tf.float32)
 
         # 4. calculate all losses
@@ -219,35 +317,27 @@ class YOLOv4Loss(Loss):
         if self.use_focal_obj_loss:
             confidence_loss = self.focal_loss(true_obj, pred_obj)
         else:
-            confidence_loss = binary_crossentropy(true_obj, pred_obj)
+            confidence_loss = self.binary_crossentropy(true_obj, pred_obj)
             confidence_loss = obj_mask * confidence_loss + (1 - obj_mask) * ignore_mask * confidence_loss
 
         # class loss
         if self.use_focal_loss:
             class_loss = self.focal_loss(true_class, pred_class)
         else:
-            class_loss = obj_mask * binary_crossentropy(true_class, pred_class)
+            class_loss = obj_mask * self.binary_crossentropy(true_class, pred_class)
 
         # box loss
         if self.use_giou_loss:
-            giou = self.giou(pred_box_coor, true_box_coor)
-            box_loss = obj_mask * box_loss_scale * (1 - giou)
-            box_loss = tf.reduce_sum(box_loss, axis=(1, 2, 3))
+            box_loss = self.positive_box_loss(pred_box_coor, true_box_coor, obj_mask, box_loss_scale, self.giou)
         elif self.use_ciou_loss:
-            ciou = self.ciou(pred_box_coor, true_box_coor)
-            box_loss = obj_mask * box_loss_scale * (1 - ciou)
-            box_loss = tf.reduce_sum(box_loss, axis=(1, 2, 3))
+            box_loss = self.positive_box_loss(pred_box_coor, true_box_coor, obj_mask, box_loss_scale, self.ciou)
         else:
             # traditional loss for xy and wh
             pred_xy = pred_raw_box[..., 0:2]
             pred_wh = pred_raw_box[..., 2:4]
 
             # invert box equation
-            grid_size = tf.shape(y_true)[1]
-            grid = tf.meshgrid(tf.range(grid_size), tf.range(grid_size))
-            grid = tf.expand_dims(tf.stack(grid, axis=-1), axis=2)
-            true_xy = true_xy * tf.cast(grid_size, tf.float32) - \
-                      tf.cast(grid, tf.float32)
+            true_xy = true_xy * grid_scale - grid
             true_wh = tf.math.log(true_wh / anchors)
             true_wh = tf.where(tf.math.is_inf(true_wh),
                                tf.zeros_like(true_wh), true_wh)
@@ -266,19 +356,64 @@ class YOLOv4Loss(Loss):
         confidence_loss = tf.reduce_sum(confidence_loss, axis=(1, 2, 3))
         class_loss = tf.reduce_sum(class_loss, axis=(1, 2, 3))
 
-        return box_loss + confidence_loss + class_loss
+        return {"box": box_loss, "confidence": confidence_loss, "class": class_loss}
 
     def yolo_loss(self, pred_sbbox: tf.Tensor, pred_mbbox: tf.Tensor, pred_lbbox: tf.Tensor, true_sbbox: tf.Tensor,
-                  true_mbbox: tf.Tensor, true_lbbox: tf.Tensor) -> tf.Tensor:
-        loss_sbbox = self.loss_layer(pred_sbbox, true_sbbox, self.anchors[self.anchor_masks[0]])
-        loss_mbbox = self.loss_layer(pred_mbbox, true_mbbox, self.anchors[self.anchor_masks[1]])
-        loss_lbbox = self.loss_layer(pred_lbbox, true_lbbox, self.anchors[self.anchor_masks[2]])
+                  true_mbbox: tf.Tensor, true_lbbox: tf.Tensor, table: DecodeTable, true_bbox: tf.Tensor = None,
+                  valid: tf.Tensor = None) -> Dict[str, tf.Tensor]:
+        losses = [self.loss_layer(pred, true, table.scale_anchors[i], table.grids[i], table.grid_scales[i],
+                                  true_bbox, valid)
+                  for i, (pred, true) in enumerate(zip((pred_sbbox, pred_mbbox, pred_lbbox),
+                                                       (true_sbbox, true_mbbox, true_lbbox)))]
 
-        return tf.reduce_sum(loss_sbbox + loss_mbbox + loss_lbbox)
+        # {"<scale>/<component>": summed over the batch}, the total loss is the sum of all values
+        components = {}
+        for scale, loss in zip(self.scale_names, losses):
+            for name in self.component_names:
+                components["{}/{}".format(scale, name)] = tf.reduce_sum(loss[name])
 
-    def call(self, y_true: tf.Tensor, y_pred: tf.Tensor) -> tf.Tensor:
-        true_s, true_m, true_l = y_true
+        return components
+
+    @staticmethod
+    def get_padded_bbox(bbox: Union[tf.Tensor, tf.RaggedTensor], num_of_bbox: tf.Tensor) -> Tuple[
+        tf.Tensor, tf.Tensor]:
+        # bbox: (batch_size, (n), (x1, y1, x2, y2, class_id)) ragged, or padded with zeros
+        # num_of_bbox: (batch_size)
+        # return the padded bbox and its (batch_size, n) validity mask
+        if isinstance(bbox, tf.RaggedTensor):
+            bbox = bbox.to_tensor()
+        valid = tf.sequence_mask(num_of_bbox, tf.shape(bbox)[1])
+
+        return bbox, valid
+
+    def encode_label(self, bbox: tf.Tensor, valid: tf.Tensor, grid_sizes: List[Tuple[tf.Tensor, tf.Tensor]],
+                     anchors: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+        # bbox: (batch_size, n, (x1, y1, x2, y2, class_id)) padded with zeros
+        # valid: (batch_size, n)
+        return encode_label(bbox=bbox[..., 0:4], label=bbox[..., 4], num_class=self.num_class,
+                            grid_sizes=grid_sizes, anchors=anchors, anchor_masks=self.anchor_masks,
+                            valid=valid)
+
+    def call(self, y_true: Union[Tuple[tf.Tensor, tf.Tensor, tf.Tensor], Dict], y_pred: tf.Tensor) -> tf.Tensor:
+        return tf.add_n(list(self.get_loss_components(y_true, y_pred).values()))
+
+    def get_loss_components(self, y_true: Union[Tuple[tf.Tensor, tf.Tensor, tf.Tensor], Dict],
+                            y_pred: tf.Tensor) -> Dict[str, tf.Tensor]:
+        # box, confidence and class loss of every scale, summed over the batch
         pred_s, pred_m, pred_l = y_pred
-        loss = self.yolo_loss(pred_s, pred_m, pred_l, true_s, true_m, true_l)
+        # geometry of the input size so any training resolution and aspect ratio works
+        table = get_output_decode_table(pred_s)
+
+        # y_true is either the dense label grids or {"bbox", "num_of_bbox"}, grids are then built on device
+        # and the padded bbox is reused for the ignore mask
+        true_bbox, valid = None, None
+        if isinstance(y_true, dict):
+            bbox, valid = YOLOv4Loss.get_padded_bbox(y_true["bbox"], y_true["num_of_bbox"])
+            true_bbox = tf.cast(bbox[..., 0:4], tf.float32)
+            y_true = self.encode_label(bbox, valid, grid_sizes=table.grid_sizes, anchors=table.anchors)
+
+        true_s, true_m, true_l = y_true
+        components = self.yolo_loss(pred_s, pred_m, pred_l, true_s, true_m, true_l, table, true_bbox=true_bbox,
+                                    valid=valid)
 
-        return loss
+        return components
@@ -0,0 +1,184 @@
+from typing import Tuple, Callable, Dict
+
+import tensorflow as tf
+
+# (bboxes, scores, classes, valid_detections) padded to max_bbox_size like combined_non_max_suppression
+Detections = Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]
+
+
+def box_iou(box_1: tf.Tensor, box_2: tf.Tensor, diou: bool = False) -> tf.Tensor:
+    # box_1, box_2: (..., (x1, y1, x2, y2)), broadcast against each other
+    int_w = tf.maximum(tf.minimum(box_1[..., 2], box_2[..., 2]) - tf.maximum(box_1[..., 0], box_2[..., 0]), 0)
+    int_h = tf.maximum(tf.minimum(box_1[..., 3], box_2[..., 3]) - tf.maximum(box_1[..., 1], box_2[..., 1]), 0)
+    int_area = int_w * int_h
+    box_1_area = (box_1[..., 2] - box_1[..., 0]) * (box_1[..., 3] - box_1[..., 1])
+    box_2_area = (box_2[..., 2] - box_2[..., 0]) * (box_2[..., 3] - box_2[..., 1])
+    iou = tf.math.divide_no_nan(int_area, box_1_area + box_2_area - int_area)
+    if not diou:
+        return iou
+
+    # diou = iou - squared center distance / squared diagonal of the enclosing box
+    center_1 = (box_1[..., 0:2] + box_1[..., 2:4]) / 2
+    center_2 = (box_2[..., 0:2] + box_2[..., 2:4]) / 2
+    enclose_wh = tf.maximum(box_1[..., 2:4], box_2[..., 2:4]) - tf.minimum(box_1[..., 0:2], box_2[..., 0:2])
+    return iou - tf.math.divide_no_nan(tf.reduce_sum(tf.square(center_1 - center_2), axis=-1),
+                                       tf.reduce_sum(tf.square(enclose_wh), axis=-1))
+
+
+def best_class(scores: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+    # (batch_size, n, num_class) => score and class of the best class of every box, (batch_size, n)
+    if scores.shape[-1] == 1:
+        # single class fast path, no argmax over classes
+        return scores[..., 0], tf.zeros_like(scores[..., 0])
+
+    return tf.reduce_max(scores, axis=-1), tf.cast(tf.argmax(scores, axis=-1), tf.float32)
+
+
+def sort_by_score(bbox: tf.Tensor, scores: tf.Tensor, classes: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+    scores, index = tf.math.top_k(scores, k=tf.shape(scores)[1])
+    return tf.gather(bbox, index, batch_dims=1), scores, tf.gather(classes, index, batch_dims=1)
+
+
+def pad_detections(bbox: tf.Tensor, scores: tf.Tensor, classes: tf.Tensor, valid_detections: tf.Tensor,
+                   max_bbox_size: int) -> Detections:
+    # zero everything after the valid detections and pad to max_bbox_size like combined_non_max_suppression
+    mask = tf.sequence_mask(valid_detections, tf.shape(scores)[1])
+    bbox = tf.where(mask[..., tf.newaxis], bbox, tf.zeros_like(bbox))
+    scores = tf.where(mask, scores, tf.zeros_like(scores))
+    classes = tf.where(mask, classes, tf.zeros_like(classes))
+
+    pad = max_bbox_size - tf.shape(scores)[1]
+    bbox = tf.pad(bbox, [[0, 0], [0, pad], [0, 0]])
+    scores = tf.pad(scores, [[0, 0], [0, pad]])
+    classes = tf.pad(classes, [[0, 0], [0, pad]])
+
+    return bbox, scores, classes, valid_detections
+
+
+def gather_detections(bbox: tf.Tensor, scores: tf.Tensor, classes: tf.Tensor, keep: tf.Tensor,
+                      max_bbox_size: int) -> Detections:
+    # the max_bbox_size best kept boxes of each image, in descending score order
+    k = tf.minimum(max_bbox_size, tf.shape(scores)[1])
+    scores, index = tf.math.top_k(tf.where(keep, scores, -tf.ones_like(scores)), k=k)
+    valid_detections = tf.minimum(tf.reduce_sum(tf.cast(keep, tf.int32), axis=-1), k)
+
+    return pad_detections(tf.gather(bbox, index, batch_dims=1), scores, tf.gather(classes, index, batch_dims=1),
+                          valid_detections, max_bbox_size)
+
+
+def greedy_suppression(overlap: tf.Tensor, classes: tf.Tensor, keep: tf.Tensor, iou_threshold: float) -> tf.Tensor:
+    # overlap: (batch_size, n, n) of boxes sorted by descending score, keep: (batch_size, n) candidates
+    # exact greedy nms, every iteration lets one box suppress the lower scored boxes of its class
+    n = tf.shape(overlap)[1]
+    lower_scored = tf.cast(tf.linalg.band_part(tf.ones((n, n)), 0, -1) - tf.eye(n), tf.bool)
+    suppress = (overlap > iou_threshold) & tf.equal(classes[:, :, tf.newaxis], classes[:, tf.newaxis]) & lower_scored
+
+    def body(i, keep):
+        return i + 1, keep & ~(suppress[:, i] & keep[:, i:i + 1])
+
+    _, keep = tf.while_loop(lambda i, _: i < n, body, (tf.constant(0), keep))
+    return keep
+
+
+def combined_nms(bbox: tf.Tensor, scores: tf.Tensor, max_bbox_size: int, max_bbox_per_class: int,
+                 iou_threshold: float, score_threshold: float) -> Detections:
+    # per class nms of every box and class pair
+    return tf.image.combined_non_max_suppression(
+        boxes=tf.reshape(bbox, (tf.shape(bbox)[0], -1, 1, 4)),
+        scores=scores,
+        max_output_size_per_class=max_bbox_per_class,
+        max_total_size=max_bbox_size,
+        iou_threshold=iou_threshold,
+        score_threshold=score_threshold
+    )
+
+
+def batched_nms(bbox: tf.Tensor, scores: tf.Tensor, max_bbox_size: int, max_bbox_per_class: int,
+                iou_threshold: float, score_threshold: float) -> Detections:
+    # one nms over the best class of every box, boxes of different classes are moved apart so they never overlap
+    scores, classes = best_class(scores)
+    offset = classes[..., tf.newaxis] * (tf.reduce_max(bbox) + 1)
+    index, valid_detections = tf.image.non_max_suppression_padded(
+        bbox + offset, scores,
+        max_output_size=max_bbox_size,
+        iou_threshold=iou_threshold,
+        score_threshold=score_threshold,
+        pad_to_max_output_size=True
+    )
+
+    # clip like combined_non_max_suppression, so the single class switch from combined keeps the same boxes
+    bbox = tf.clip_by_value(tf.gather(bbox, index, batch_dims=1), 0.0, 1.0)
+
+    return pad_detections(bbox, tf.gather(scores, index, batch_dims=1), tf.gather(classes, index, batch_dims=1),
+                          valid_detections, max_bbox_size)
+
+
+def diou_nms(bbox: tf.Tensor, scores: tf.Tensor, max_bbox_size: int, max_bbox_per_class: int,
+             iou_threshold: float, score_threshold: float) -> Detections:
+    # greedy nms that suppresses by diou, close boxes with distant centers both survive
+    bbox, scores, classes = sort_by_score(bbox, *best_class(scores))
+    overlap = box_iou(bbox[:, :, tf.newaxis], bbox[:, tf.newaxis], diou=True)
+    keep = greedy_suppression(overlap, classes, scores >= score_threshold, iou_threshold)
+
+    return gather_detections(bbox, scores, classes, keep, max_bbox_size)
+
+
+def matrix_nms(bbox: tf.Tensor, scores: tf.Tensor, max_bbox_size: int, max_bbox_per_class: int,
+               iou_threshold: float, score_threshold: float, sigma: float = 2.0) -> Detections:
+    # scores decay by their overlap with higher scored boxes of the same class in one matrix op, no loop
+    bbox, scores, classes = sort_by_score(bbox, *best_class(scores))
+    n = tf.shape(scores)[1]
+    higher_scored = tf.linalg.band_part(tf.ones((n, n)), 0, -1) - tf.eye(n)
+    same_class = tf.cast(tf.equal(classes[:, :, tf.newaxis], classes[:, tf.newaxis]), tf.float32)
+    # iou[b, i, j] of box i with the lower scored box j
+    iou = box_iou(bbox[:, :, tf.newaxis], bbox[:, tf.newaxis]) * same_class * higher_scored
+
+    # a box that is itself suppressed suppresses less
+    compensate = tf.reduce_max(iou, axis=1)[:, :, tf.newaxis]
+    decay = tf.exp(-sigma * (tf.square(iou) - tf.square(compensate)))
+    scores = scores * tf.minimum(tf.reduce_min(decay, axis=1), 1.0)
+
+    return gather_detections(bbox, scores, classes, scores >= score_threshold, max_bbox_size)
+
+
+def soft_nms(bbox: tf.Tensor, scores: tf.Tensor, max_bbox_size: int, max_bbox_per_class: int,
+             iou_threshold: float, score_threshold: float, sigma: float = 0.5) -> Detections:
+    # gaussian soft-nms, each iteration takes the best box and decays the scores of its class by their overlap
+    scores, classes = best_class(scores)
+    num_of_box = tf.shape(scores)[1]
+    num_of_detection = tf.minimum(max_bbox_size, num_of_box)
+
+    def body(i, scores, selected):
+        index = tf.argmax(scores, axis=-1, output_type=tf.int32)
+        best_box = tf.gather(bbox, index, batch_dims=1)
+        best_class_id = tf.gather(classes, index, batch_dims=1)
+        selected = selected.write(i, tf.stack([tf.cast(index, tf.float32), tf.reduce_max(scores, axis=-1)], axis=-1))
+
+        iou = box_iou(best_box[:, tf.newaxis], bbox)
+        decay = tf.where(tf.equal(classes, best_class_id[:, tf.newaxis]), tf.exp(-tf.square(iou) / sigma),
+                         tf.ones_like(iou))
+        scores = scores * decay * (1 - tf.one_hot(index, num_of_box))
+        return i + 1, scores, selected
+
+    _, _, selected = tf.while_loop(lambda i, *_: i < num_of_detection, body,
+                                   (tf.constant(0), scores, tf.TensorArray(tf.float32, size=num_of_detection)))
+
+    # (batch_size, num_of_detection, (index, score)), the selected scores never increase
+    selected = tf.transpose(selected.stack(), (1, 0, 2))
+    index = tf.cast(selected[..., 0], tf.int32)
+    valid_detections = tf.reduce_sum(tf.cast(selected[..., 1] >= score_threshold, tf.int32), axis=-1)
+
+    return pad_detections(tf.gather(bbox, index, batch_dims=1), selected[..., 1],
+                          tf.gather(classes, index, batch_dims=1), valid_detections, max_bbox_size)
+
+
+# engines that compare every pair of candidates or loop over them, they need a pre_nms_top_k bound
+DENSE_NMS_ENGINES = ("diou", "matrix", "soft")
+
+NMS_ENGINES: Dict[str, Callable[..., Detections]] = {
+    "combined": combined_nms,
+    "batched": batched_nms,
+    "diou": diou_nms,
+    "matrix": matrix_nms,
+    "soft": soft_nms
+}
@@ -0,0 +1,17 @@
+import tensorflow as tf
+
+from model.layer import MyConv2D
+from model.yolov4 import YOLOv4
+
+
+def optimize_for_inference(model: YOLOv4, image_size: int) -> YOLOv4:
+    # lean clone of a built YOLOv4: every MyConv2D is fused into a biased conv and its activation,
+    # batchnorm, dropblock and identity branches are gone, the original model is left untouched
+    lean_model = YOLOv4(num_class=model.head.num_class)
+    lean_model(tf.zeros((1, image_size, image_size, 3)))
+    lean_model.set_weights(model.get_weights())
+
+    for layer in [layer for layer in lean_model.submodules if isinstance(layer, MyConv2D)]:
+        layer.fuse()
+
+    return lean_model
@@ -1,25 +1,77 @@
-from typing import Tuple
+from typing import Tuple, List, Union
 
 import numpy as np
 import tensorflow as tf
+from tensorflow.keras import backend as K
 
 from config import cfg
+from model.nms import NMS_ENGINES, DENSE_NMS_ENGINES
+
+
+class DecodeTable:
+    # grid offsets, normalized anchors and strides of one input resolution, shared by decode, YOLOv4Loss and
+    # label encoding so the three never disagree on the geometry
+    strides = (32, 16, 8)
+
+    def __init__(self, image_shape: Union[Tuple[int, int], tf.Tensor]):
+        # image_shape: (height, width) of the input, rounded up to a multiple of 32 like the network output
+        grid_h, grid_w = (image_shape[0] + 31) // 32, (image_shape[1] + 31) // 32
+        self.grid_sizes = [(grid_h * 32 // stride, grid_w * 32 // stride) for stride in self.strides]
+        anchor_masks = cfg.anchors.get_anchor_masks()
+
+        if isinstance(grid_h, (int, np.integer)):
+            # numpy constants can be captured by any graph
+            grid_h, grid_w = int(grid_h), int(grid_w)
+            self.grid_sizes = [(int(h), int(w)) for h, w in self.grid_sizes]
+            self.anchors = cfg.anchors.yolo_anchors / np.array([grid_w * 32, grid_h * 32], np.float32)
+            self.scale_anchors = [self.anchors[anchor_mask] for anchor_mask in anchor_masks]
+            self.grids = [np.stack(np.meshgrid(np.arange(w), np.arange(h)), axis=-1)[:, :, np.newaxis].astype(
+                np.float32) for h, w in self.grid_sizes]
+            self.grid_scales = [np.array([w, h], np.float32) for h, w in self.grid_sizes]
+        else:
+            # dynamic shapes, e.g. aspect ratio buckets, are built in the graph
+            self.anchors = tf.constant(cfg.anchors.yolo_anchors, tf.float32) / tf.cast(
+                tf.stack([grid_w * 32, grid_h * 32]), tf.float32)
+            self.scale_anchors = [tf.gather(self.anchors, anchor_mask) for anchor_mask in anchor_masks]
+            self.grids = [tf.cast(tf.stack(tf.meshgrid(tf.range(w), tf.range(h)), axis=-1)[:, :, tf.newaxis],
+                                  tf.float32) for h, w in self.grid_sizes]
+            self.grid_scales = [tf.cast(tf.stack([w, h]), tf.float32) for h, w in self.grid_sizes]
+
+
+_decode_tables = {}
+
+
+def get_decode_table(image_shape: Union[Tuple[int, int], tf.Tensor]) -> DecodeTable:
+    # one cached table per static resolution, dynamic shapes get a table built in the graph
+    if isinstance(image_shape, tf.Tensor) or not all(isinstance(side, (int, np.integer)) for side in image_shape):
+        return DecodeTable(image_shape)
+
+    key = (int(image_shape[0]) + 31) // 32, (int(image_shape[1]) + 31) // 32
+    if key not in _decode_tables:
+        _decode_tables[key] = DecodeTable((key[0] * 32, key[1] * 32))
+    return _decode_tables[key]
+
+
+def get_output_decode_table(pred_sbbox: tf.Tensor) -> DecodeTable:
+    # the small scale output has stride 32
+    grid_size = pred_sbbox.shape[1:3]
+    if grid_size.is_fully_defined():
+        return get_decode_table((grid_size[0] * 32, grid_size[1] * 32))
+    return get_decode_table(tf.shape(pred_sbbox)[1:3] * 32)
 
 
 @tf.function
-def decode(pred: tf.Tensor, anchors: np.ndarray) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
-    # pred: (batch_size, grid, grid, anchors, (x, y, w, h, obj, ...classes))
-    grid_size = tf.shape(pred)[1]
+def decode(pred: tf.Tensor, anchors: tf.Tensor, grid: tf.Tensor, grid_scale: tf.Tensor) -> Tuple[
+    tf.Tensor, tf.Tensor, tf.Tensor]:
+    # pred: (batch_size, grid_y, grid_x, anchors, (x, y, w, h, obj, ...classes))
+    # anchors, grid and grid_scale of the output scale come from its DecodeTable
     box_xy, box_wh, objectness, class_probs = tf.split(pred, (2, 2, 1, -1), axis=-1)
 
     box_xy = cfg.grid_sensitivity_ratio * tf.sigmoid(box_xy)
     objectness = tf.sigmoid(objectness)
     class_probs = tf.sigmoid(class_probs)
 
-    grid = tf.meshgrid(tf.range(grid_size), tf.range(grid_size))
-    grid = tf.expand_dims(tf.stack(grid, axis=-1), axis=2)
-
-    box_xy = (box_xy + tf.cast(grid, tf.float32)) / tf.cast(grid_size, tf.float32)
+    box_xy = (box_xy + grid) / grid_scale
     box_wh = tf.exp(box_wh) * anchors
 
     box_x1y1 = box_xy - box_wh / 2
@@ -39,20 +91,56 @@ def flatten_output(outputs: Tuple[tf.Tensor, tf.Tensor, tf.Tensor]) -> Tuple[tf.
     return bbox, objectness, class_probs
 
 
+def prune_candidates(
+        bbox: tf.Tensor,
+        confidence: tf.Tensor,
+        class_probs: tf.Tensor,
+        score_threshold: float,
+        top_k: int,
+        objectness_threshold: float
+) -> Tuple[tf.Tensor, tf.Tensor]:
+    # bbox: (batch_size, n, 4), confidence: (batch_size, n, 1), class_probs: (batch_size, n, num_class)
+    # return the top_k candidates of each image: (batch_size, k, 4) and their (batch_size, k, num_class) scores
+    confidence = tf.where(confidence >= objectness_threshold, confidence, tf.zeros_like(confidence))
+    scores = confidence * class_probs
+    scores = tf.where(scores >= score_threshold, scores, tf.zeros_like(scores))
+
+    # rank the anchors by their best class score, the class expansion only happens on the kept ones
+    if top_k <= 0:
+        return bbox, scores
+
+    _, index = tf.math.top_k(tf.reduce_max(scores, axis=-1), k=tf.minimum(top_k, tf.shape(bbox)[1]))
+    bbox = tf.gather(bbox, index, batch_dims=1)
+    scores = tf.gather(scores, index, batch_dims=1)
+
+    return bbox, scores
+
+
 @tf.function
 def non_max_suppression(
         inputs: Tuple[tf.Tensor, tf.Tensor, tf.Tensor],
         iou_threshold: float = cfg.yolo_iou_threshold,
         score_threshold: float = cfg.yolo_score_threshold,
-        max_bbox_size: int = cfg.max_bbox_size
+        max_bbox_size: int = cfg.max_bbox_size,
+        max_bbox_per_class: int = None,
+        pre_nms_top_k: int = cfg.pre_nms_top_k,
+        objectness_threshold: float = None,
+        engine: str = cfg.nms_engine
 ) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]:
-    anchors = cfg.anchors.get_anchors()
-    anchor_masks = cfg.anchors.get_anchor_masks()
+    # engine: one of model.nms.NMS_ENGINES, max_bbox_per_class only applies to combined
+    # max_bbox_size: detections per image, max_bbox_per_class: detections per class, defaults to max_bbox_size
+    # pre_nms_top_k: candidates per image kept before nms, 0 keeps all
+    # objectness_threshold: objectness gate, defaults to score_threshold since score <= objectness
+    # the dense engines build (n, n) iou matrices, every anchor at 608px would be ~2GB per image
+    if engine in DENSE_NMS_ENGINES and pre_nms_top_k <= 0:
+        raise ValueError("NMS engine {} needs pre_nms_top_k > 0".format(engine))
 
     output_small, output_medium, output_large = inputs
-    output_small = decode(output_small, anchors[anchor_masks[0]])
-    output_medium = decode(output_medium, anchors[anchor_masks[1]])
-    output_large = decode(output_large, anchors[anchor_masks[2]])
+    table = get_output_decode_table(output_small)
+
+    output_small = decode(output_small, table.scale_anchors[0], table.grids[0], table.grid_scales[0])
+    output_medium = decode(output_medium, table.scale_anchors[1], table.grids[1], table.grid_scales[1])
+    output_large = decode(output_large, table.scale_anchors[2], table.grids[2], table.grid_scales[2])
 
     # flatten output to shape [batch_size, toto_grid_size, *]
     bbox_small, objectness_small, class_probs_small = flatten_output(output_small)
@@ -64,15 +152,94 @@ def non_max_suppression(
     confidence = tf.concat([objectness_small, objectness_medium, objectness_large], axis=1)
     class_probs = tf.concat([class_probs_small, class_probs_medium, class_probs_large], axis=1)
 
-    scores = confidence * class_probs
-
-    bboxes, scores, classes, valid_detections = tf.image.combined_non_max_suppression(
-        boxes=tf.reshape(bbox, (tf.shape(bbox)[0], -1, 1, 4)),
-        scores=tf.reshape(scores, (tf.shape(scores)[0], -1, tf.shape(scores)[-1])),
-        max_output_size_per_class=max_bbox_size,
-        max_total_size=max_bbox_size,
-        iou_threshold=iou_threshold,
-        score_threshold=score_threshold
-    )
-
-    return bboxes, scores, classes, valid_detections
+    bbox, scores = prune_candidates(bbox, confidence, class_probs, score_threshold, pre_nms_top_k,
+                                    score_threshold if objectness_threshold is None else objectness_threshold)
+
+    # with a single class, per class nms is one plain nms
+    if engine == "combined" and class_probs.shape[-1] == 1:
+        engine = "batched"
+
+    return NMS_ENGINES[engine](bbox, scores, max_bbox_size=max_bbox_size,
+                               max_bbox_per_class=max_bbox_per_class or max_bbox_size,
+                               iou_threshold=iou_threshold, score_threshold=score_threshold)
+
+
+def floor_divide(x: tf.Tensor, y: tf.Tensor) -> tf.Tensor:
+    # same rounding as np.floor_divide so grid indices match the numpy label encoder exactly
+    mod = tf.truncatemod(x, y)
+    div = (x - mod) / y
+    floor_div = tf.floor(div)
+    floor_div = tf.where(div - floor_div > 0.5, floor_div + 1, floor_div)
+
+    return floor_div
+
+
+def encode_label(
+        bbox: tf.Tensor,
+        label: tf.Tensor,
+        num_class: int,
+        grid_sizes: List[Union[int, tf.Tensor, Tuple]],
+        anchors: Union[np.ndarray, tf.Tensor],
+        anchor_masks: np.ndarray,
+        valid: tf.Tensor = None
+) -> Tuple[tf.Tensor, ...]:
+    # bbox: (batch_size, n, (x_min, y_min, x_max, y_max))
+    # label: (batch_size, n)
+    # valid: (batch_size, n), False for padded boxes
+    # grid_sizes: grid or (grid_y, grid_x) of each anchor mask
+    # return one grid per anchor mask: (batch_size, grid_y, grid_x, anchors, (x, y, w, h, obj, ...classes))
+    bbox = tf.cast(bbox, tf.float32)
+    label = tf.cast(label, tf.int32)
+    if valid is None:
+        valid = tf.ones_like(label, dtype=tf.bool)
+
+    # bbox = [x_min, y_min, x_max, y_max] => [x_center, y_center, w, h]
+    box_xy = (bbox[..., 0:2] + bbox[..., 2:4]) / 2
+    box_wh = bbox[..., 2:4] - bbox[..., 0:2]
+    box = tf.clip_by_value(tf.concat([box_xy, box_wh], axis=-1), 0.0, 1 - K.epsilon())
+    box_xy, box_wh = box[..., 0:2], box[..., 2:4]
+
+    # find the best anchor
+    anchors = tf.convert_to_tensor(anchors, tf.float32)
+    anchor_area = anchors[..., 0] * anchors[..., 1]
+    box_wh = tf.expand_dims(box_wh, axis=-2)  # shape = (batch_size, n, 1, 2)
+    box_area = box_wh[..., 0] * box_wh[..., 1]
+    intersection = tf.minimum(box_wh[..., 0], anchors[..., 0]) * tf.minimum(box_wh[..., 1], anchors[..., 1])
+    iou = intersection / (box_area + anchor_area - intersection)
+    anchor_idx = tf.argmax(iou, axis=-1, output_type=tf.int32)  # shape = (batch_size, n)
+
+    # grid[y][x][anchor] = [x, y, w, h, obj, ...class_id]
+    grid_value = tf.concat([box, tf.ones_like(box[..., 0:1]), tf.one_hot(label, num_class)], axis=-1)
+
+    batch_size, num_of_bbox = tf.shape(label)[0], tf.shape(label)[1]
+    batch_idx = tf.broadcast_to(tf.range(batch_size)[:, tf.newaxis], (batch_size, num_of_bbox))
+    box_position = tf.broadcast_to(tf.range(num_of_bbox)[tf.newaxis], (batch_size, num_of_bbox))
+
+    grids = []
+    for anchor_mask, grid_size in zip(anchor_masks, grid_sizes):
+        grid_h, grid_w = grid_size if isinstance(grid_size, (tuple, list)) else (grid_size, grid_size)
+        num_anchor = len(anchor_mask)
+        matches = tf.equal(anchor_idx[..., tf.newaxis], tf.constant(anchor_mask, tf.int32))
+        in_mask = tf.logical_and(tf.reduce_any(matches, axis=-1), valid)
+        box_index = tf.argmax(tf.cast(matches, tf.int32), axis=-1, output_type=tf.int32)
+
+        cell_size = tf.cast(1 / tf.cast(tf.stack([grid_w, grid_h]), tf.float64), tf.float32)
+        grid_xy = tf.cast(floor_divide(box_xy, cell_size), tf.int32)
+        grid_x = tf.clip_by_value(grid_xy[..., 0], 0, grid_w - 1)
+        grid_y = tf.clip_by_value(grid_xy[..., 1], 0, grid_h - 1)
+
+        # several boxes may fall in the same cell and anchor, the last one wins
+        cell_idx = ((batch_idx * grid_h + grid_y) * grid_w + grid_x) * num_anchor + box_index
+        cell_idx = tf.where(in_mask, cell_idx, tf.zeros_like(cell_idx))
+        winner = tf.math.unsorted_segment_max(tf.where(in_mask, box_position, -tf.ones_like(box_position)),
+                                              cell_idx, num_segments=batch_size * grid_h * grid_w * num_anchor)
+        keep = tf.logical_and(in_mask, tf.equal(tf.gather(winner, cell_idx), box_position))
+
+        grid = tf.scatter_nd(
+            indices=tf.stack([batch_idx, grid_y, grid_x, box_index], axis=-1),
+            updates=grid_value * tf.cast(keep, tf.float32)[..., tf.newaxis],
+            shape=(batch_size, grid_h, grid_w, num_anchor, 5 + num_class)
+        )
+        grids.append(grid)
+
+    return tuple(grids)
@@ -0,0 +1,35 @@
+import argparse
+
+import tensorflow_datasets as tfds
+
+from config import cfg
+from dataset.yolov4_coco_dataset import COCO2017Dataset
+from dataset.yolov4_local_dataset import LocalDataset
+from dataset.yolov4_synthetic_dataset import SyntheticDataset
+from dataset.yolov4_wider_face_dataset import WiderFaceDatset
+
+
+def create_dataset_generator(dataset, image_size, mode):
+    if dataset == "coco":
+        return COCO2017Dataset(image_size=image_size, mode=mode, use_cache=False)
+    elif dataset == "wider_face":
+        return WiderFaceDatset(image_size=image_size, mode=mode, use_cache=False)
+    elif dataset == "synthetic":
+        return SyntheticDataset(image_size=image_size, mode=mode, use_cache=False)
+    elif dataset == "local":
+        return LocalDataset(image_size=image_size, mode=mode, use_cache=False)
+    else:
+        print("Unknown dataset!")
+        exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write the preprocessed TFRecord cache of a dataset')
+    parser.add_argument('-d', '--dataset', type=str, default=cfg.dataset, help='Dataset name, coco, wider_face, synthetic or local')
+    parser.add_argument('-i', '--image_size', type=int, default=cfg.image_size, help='Reshape size of the image')
+    parser.add_argument('-n', '--num_shards', type=int, default=cfg.cache_num_shards, help='Number of TFRecord shards')
+    args = parser.parse_args()
+
+    for mode in [tfds.Split.TRAIN, tfds.Split.VALIDATION]:
+        dataset = create_dataset_generator(dataset=args.dataset, image_size=args.image_size, mode=mode)
+        dataset.write_cache(num_shards=args.num_shards)
@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import time
+from typing import Dict
+
+import tensorflow as tf
+
+from config import cfg
+from model.optimize import optimize_for_inference
+from model.yolov4 import YOLOv4
+
+
+def randomize_batch_norm(model: tf.keras.Model, seed: int = 0):
+    # a freshly initialized batchnorm is an identity, random statistics make the folding check meaningful
+    tf.random.set_seed(seed)
+    for layer in model.submodules:
+        if isinstance(layer, tf.keras.layers.BatchNormalization):
+            shape = layer.moving_mean.shape
+            layer.gamma.assign(tf.random.uniform(shape, 0.5, 1.5))
+            layer.beta.assign(tf.random.normal(shape, stddev=0.1))
+            layer.moving_mean.assign(tf.random.normal(shape, stddev=0.1))
+            layer.moving_variance.assign(tf.random.uniform(shape, 0.5, 1.5))
+
+
+def profile_latency(model: tf.keras.Model, x: tf.Tensor, num_steps: int, warmup_steps: int) -> float:
+    predict = tf.function(lambda x: model(x, training=False))
+    for _ in range(warmup_steps):
+        predict(x)
+
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        outputs = predict(x)
+        outputs[0].numpy()  # wait for the call to finish
+    return (time.perf_counter() - start) / num_steps * 1000
+
+
+def profile_inference(batch_size: int, image_size: int, num_class: int, checkpoint_dir: str, num_steps: int,
+                      warmup_steps: int) -> Dict:
+    # max abs difference of the raw outputs and ms per call of the original and the lean model on cpu
+    with tf.device("/CPU:0"):
+        model = YOLOv4(num_class=num_class)
+        model(tf.zeros((1, image_size, image_size, 3)))
+        if checkpoint_dir:
+            tf.train.Checkpoint(net=model).restore(tf.train.latest_checkpoint(checkpoint_dir)).expect_partial()
+        else:
+            randomize_batch_norm(model)
+        lean_model = optimize_for_inference(model, image_size)
+
+        x = tf.random.uniform((batch_size, image_size, image_size, 3), -1, 1)
+        max_abs_diff = [float(tf.reduce_max(tf.abs(output - lean_output)))
+                        for output, lean_output in zip(model(x, training=False), lean_model(x, training=False))]
+
+        original_ms = profile_latency(model, x, num_steps, warmup_steps)
+        lean_ms = profile_latency(lean_model, x, num_steps, warmup_steps)
+
+    return {
+        "max_abs_diff": dict(zip(["small", "medium", "large"], max_abs_diff)),
+        "original_latency_ms": original_ms,
+        "lean_latency_ms": lean_ms,
+        "speedup": original_ms / lean_ms
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the batchnorm folded YOLOv4 against the original on cpu')
+    parser.add_argument('-b', '--batch_size', type=int, default=1, help='Batch size')
+    parser.add_argument('-i', '--image_size', type=int, default=cfg.image_size, help='Reshape size of the image')
+    parser.add_argument('-c', '--num_class', type=int, default=80, help='Number of classes')
+    parser.add_argument('-k', '--checkpoint_dir', type=str, default='',
+                        help='Training checkpoint directory, random batchnorm statistics when empty')
+    parser.add_argument('-s', '--steps', type=int, default=10, help='Number of timed calls per model')
+    parser.add_argument('-w', '--warmup_steps', type=int, default=2, help='Untimed calls before timing')
+    parser.add_argument('-o', '--output', type=str, default='logs/profile/inference.json', help='JSON report path')
+    args = parser.parse_args()
+
+    report = {
+        "batch_size": args.batch_size,
+        "image_size": args.image_size,
+        "num_class": args.num_class,
+        "cpu": profile_inference(args.batch_size, args.image_size, args.num_class, args.checkpoint_dir, args.steps,
+                                 args.warmup_steps)
+    }
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import time
+from typing import Dict, List
+
+import tensorflow as tf
+
+from config import cfg
+from model.loss import YOLOv4Loss
+from model.utils import get_output_decode_table
+
+
+def create_inputs(batch_size: int, image_size: int, num_class: int, num_of_bbox: int, seed: int = 0) -> Dict:
+    # random predictions at every scale, random true boxes encoded into the label grids
+    tf.random.set_seed(seed)
+    grid = image_size // 32
+    preds = tuple(tf.random.normal((batch_size, grid * scale, grid * scale, 3, 5 + num_class))
+                  for scale in (1, 2, 4))
+
+    xy = tf.random.uniform((batch_size, num_of_bbox, 2), 0.1, 0.9)
+    wh = tf.random.uniform((batch_size, num_of_bbox, 2), 0.02, 0.2)
+    label = tf.cast(tf.random.uniform((batch_size, num_of_bbox), 0, num_class, dtype=tf.int32), tf.float32)
+    bbox = tf.concat([xy - wh / 2, xy + wh / 2, label[..., tf.newaxis]], axis=-1)
+    num_of_bbox = tf.random.uniform((batch_size,), 1, num_of_bbox + 1, dtype=tf.int32)
+
+    return {"preds": preds, "bbox": bbox, "num_of_bbox": num_of_bbox}
+
+
+def get_ignore_mask_fn(loss_fn: YOLOv4Loss, mode: str):
+    @tf.function
+    def ignore_mask(preds, bbox, num_of_bbox):
+        table = get_output_decode_table(preds[0])
+        bbox, valid = YOLOv4Loss.get_padded_bbox(bbox, num_of_bbox)
+        grids = loss_fn.encode_label(bbox, valid, grid_sizes=table.grid_sizes, anchors=table.anchors)
+
+        best_ious = []
+        for i, (pred, grid) in enumerate(zip(preds, grids)):
+            pred_box_coor, _, _, _ = YOLOv4Loss.decode_loss(pred, table.scale_anchors[i], table.grids[i],
+                                                            table.grid_scales[i])
+            true_xy, true_wh = grid[..., 0:2], grid[..., 2:4]
+            true_box_coor = tf.concat([true_xy - true_wh / 2.0, true_xy + true_wh / 2.0], axis=-1)
+            obj_mask = grid[..., 4]
+            if mode == "padded":
+                best_ious.append(loss_fn.get_best_iou(pred_box_coor, true_box_coor, obj_mask,
+                                                      true_bbox=bbox[..., 0:4], valid=valid))
+            else:
+                best_ious.append(loss_fn.get_best_iou(pred_box_coor, true_box_coor, obj_mask))
+
+        return [tf.cast(best_iou < loss_fn.yolo_iou_threshold, tf.float32) for best_iou in best_ious]
+
+    return ignore_mask
+
+
+def profile_ignore_mask(batch_sizes: List[int], image_size: int, num_class: int, num_of_bbox: int, num_steps: int,
+                        warmup_steps: int) -> Dict:
+    # map_fn: per image boolean_mask of the label grid, top_k: static shape gather of the label grid,
+    # padded: one batched iou against the padded true boxes
+    modes = {
+        "map_fn": YOLOv4Loss(num_class, cfg.yolo_iou_threshold),
+        "top_k": YOLOv4Loss(num_class, cfg.yolo_iou_threshold, static_shape=True, max_bbox_size=num_of_bbox),
+        "padded": YOLOv4Loss(num_class, cfg.yolo_iou_threshold)
+    }
+
+    results = {}
+    for batch_size in batch_sizes:
+        inputs = create_inputs(batch_size, image_size, num_class, num_of_bbox)
+        results[batch_size] = {}
+        for mode, loss_fn in modes.items():
+            ignore_mask = get_ignore_mask_fn(loss_fn, mode)
+            for _ in range(warmup_steps):
+                ignore_mask(inputs["preds"], inputs["bbox"], inputs["num_of_bbox"])
+
+            start = time.perf_counter()
+            for _ in range(num_steps):
+                masks = ignore_mask(inputs["preds"], inputs["bbox"], inputs["num_of_bbox"])
+                float(masks[0][0, 0, 0, 0])  # wait for the step to finish
+            results[batch_size]["{}_ms".format(mode)] = (time.perf_counter() - start) / num_steps * 1000
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Profile the ignore mask computation of YOLOv4Loss')
+    parser.add_argument('-b', '--batch_sizes', type=int, nargs='+', default=[4, 8, 16, 32, 64], help='Batch sizes')
+    parser.add_argument('-i', '--image_size', type=int, default=cfg.image_size, help='Reshape size of the image')
+    parser.add_argument('-c', '--num_class', type=int, default=80, help='Number of classes')
+    parser.add_argument('-n', '--num_of_bbox', type=int, default=50, help='Maximum number of true boxes per image')
+    parser.add_argument('-s', '--steps', type=int, default=10, help='Number of timed steps per batch size')
+    parser.add_argument('-w', '--warmup_steps', type=int, default=2, help='Untimed steps before timing')
+    parser.add_argument('-o', '--output', type=str, default='logs/profile/loss.json', help='JSON report path')
+    args = parser.parse_args()
+
+    report = {
+        "image_size": args.image_size,
+        "num_class": args.num_class,
+        "num_of_bbox": args.num_of_bbox,
+        "ignore_mask": profile_ignore_mask(args.batch_sizes, args.image_size, args.num_class, args.num_of_bbox,
+                                           args.steps, args.warmup_steps)
+    }
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
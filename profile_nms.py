@@ -0,0 +1,97 @@
+import argparse
+import json
+import os
+import time
+from typing import Dict, List
+
+import tensorflow as tf
+
+from config import cfg
+from metrics.mean_average_precision.detection_map import DetectionMAP
+from model.nms import NMS_ENGINES
+from model.utils import non_max_suppression
+
+
+def create_outputs(batch_size: int, image_size: int, num_class: int, seed: int = 0):
+    # random raw outputs of the three scales, objectness is biased low like a trained model
+    tf.random.set_seed(seed)
+    grid = image_size // 32
+    outputs = []
+    for scale in (1, 2, 4):
+        pred = tf.random.normal((batch_size, grid * scale, grid * scale, 3, 5 + num_class))
+        box, objectness, class_probs = tf.split(pred, (4, 1, -1), axis=-1)
+        outputs.append(tf.concat([box, objectness * 3 - 4, class_probs], axis=-1))
+
+    return tuple(outputs)
+
+
+def profile_latency(engines: List[str], outputs, num_steps: int, warmup_steps: int) -> Dict:
+    # ms per call and mean number of detections per image of every engine on the same outputs
+    results = {}
+    for engine in engines:
+        for _ in range(warmup_steps):
+            non_max_suppression(outputs, engine=engine)
+
+        start = time.perf_counter()
+        for _ in range(num_steps):
+            _, _, _, valid_detections = non_max_suppression(outputs, engine=engine)
+            valid_detections.numpy()  # wait for the call to finish
+        results[engine] = {
+            "latency_ms": (time.perf_counter() - start) / num_steps * 1000,
+            "detections_per_image": float(tf.reduce_mean(tf.cast(valid_detections, tf.float32)))
+        }
+
+    return results
+
+
+def profile_map(engines: List[str], batch_size: int, image_size: int, num_of_batch: int) -> Dict:
+    # mAP@0.5 of the latest training checkpoint on the same validation batches for every engine
+    from train import Trainer
+
+    trainer = Trainer(batch_size=batch_size, image_size=image_size)
+    trainer.ckpt.restore(trainer.manager.latest_checkpoint).expect_partial()
+    batches = list(trainer.dataset_val.take(num_of_batch))
+
+    results = {}
+    for engine in engines:
+        mAP = DetectionMAP(trainer.num_class)
+        for data in batches:
+            x = data['image']
+            if x.dtype == tf.uint8:
+                x = trainer.normalize_image(x)
+            bboxes, scores, classes, valid_detections = non_max_suppression(trainer.model(x), engine=engine)
+            mAP.evaluate_batch(bboxes.numpy(), classes.numpy(), scores.numpy(), valid_detections.numpy(),
+                               data['bbox'])
+        results[engine] = {"mAP@0.5": float(mAP.get_mAP())}
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the latency and accuracy of the NMS engines')
+    parser.add_argument('-e', '--engines', type=str, nargs='+', default=list(NMS_ENGINES), help='NMS engines')
+    parser.add_argument('-b', '--batch_size', type=int, default=cfg.batch_size, help='Batch size')
+    parser.add_argument('-i', '--image_size', type=int, default=cfg.image_size, help='Reshape size of the image')
+    parser.add_argument('-c', '--num_class', type=int, default=80, help='Number of classes of the random outputs')
+    parser.add_argument('-s', '--steps', type=int, default=20, help='Number of timed calls per engine')
+    parser.add_argument('-w', '--warmup_steps', type=int, default=2, help='Untimed calls before timing')
+    parser.add_argument('-m', '--map_batches', type=int, default=0,
+                        help='Validation batches of cfg.dataset to compute mAP on with the latest checkpoint, '
+                             '0 skips it')
+    parser.add_argument('-o', '--output', type=str, default='logs/profile/nms.json', help='JSON report path')
+    args = parser.parse_args()
+
+    report = {
+        "batch_size": args.batch_size,
+        "image_size": args.image_size,
+        "num_class": args.num_class,
+        "latency": profile_latency(args.engines, create_outputs(args.batch_size, args.image_size, args.num_class),
+                                   args.steps, args.warmup_steps)
+    }
+    if args.map_batches > 0:
+        report["accuracy"] = profile_map(args.engines, args.batch_size, args.image_size, args.map_batches)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,198 @@
+import argparse
+import json
+import os
+import time
+from typing import Dict, List
+
+import tensorflow as tf
+import tensorflow_datasets as tfds
+
+from config import cfg
+from dataset.yolov4_coco_dataset import COCO2017Dataset
+from dataset.yolov4_dataset import YOLOv4Dataset
+from dataset.yolov4_local_dataset import LocalDataset
+from dataset.yolov4_synthetic_dataset import SyntheticDataset
+from dataset.yolov4_wider_face_dataset import WiderFaceDatset
+from train import Trainer
+
+
+def create_dataset_generator(dataset, image_size, batch_size, mode, **kwargs):
+    if dataset == "coco":
+        return COCO2017Dataset(image_size=image_size, batch_size=batch_size, mode=mode, **kwargs)
+    elif dataset == "wider_face":
+        return WiderFaceDatset(image_size=image_size, batch_size=batch_size, mode=mode, **kwargs)
+    elif dataset == "synthetic":
+        return SyntheticDataset(image_size=image_size, batch_size=batch_size, mode=mode, **kwargs)
+    elif dataset == "local":
+        return LocalDataset(image_size=image_size, batch_size=batch_size, mode=mode, **kwargs)
+    else:
+        print("Unknown dataset!")
+        exit(1)
+
+
+def time_dataset(dataset: tf.data.Dataset, num_of_element: int) -> float:
+    # seconds to pull num_of_element elements, the first element is pulled before the clock starts
+    iterator = iter(dataset)
+    next(iterator)
+    start = time.perf_counter()
+    for _ in range(num_of_element):
+        next(iterator)
+
+    return time.perf_counter() - start
+
+
+def get_stages(generator: YOLOv4Dataset) -> List[Dict]:
+    # cumulative prefixes of map_func, each stage adds one step on top of the previous one
+    def decode(feature):
+        bbox, label = generator.get_bbox_and_label(feature)
+        image = generator.decode_image(feature)
+        return {"image": image, "bbox": bbox, "label": label,
+                "image_shape": generator.get_image_shape(tf.shape(image)[0:2]),
+                "original_image_size": tf.shape(image)[0:2]}
+
+    def transform_bbox(x):
+        x = dict(x)
+        x["bbox"] = generator.transform_bbox(x["bbox"], x["original_image_size"], x["image_shape"])
+        return x
+
+    def map_label_func(x):
+        x = dict(x)
+        x["grids"] = generator.map_label_func(x["bbox"], x["label"], x["image_shape"])
+        return x
+
+    def map_image_func(x):
+        feature = {
+            "image": generator.map_image_func(generator.letterbox_image(x["image"], x["image_shape"])),
+            "bbox": generator.pad_class(x["bbox"], x["label"]),
+            "num_of_bbox": tf.shape(x["bbox"])[0]
+        }
+        if not generator.compact_label:
+            feature["label"] = x["grids"]
+        return feature
+
+    stages = [
+        {"name": "decode", "map": decode},
+        {"name": "transform_bbox", "map": transform_bbox}
+    ]
+    # with compact labels map_func never encodes the grids, YOLOv4Loss does it on device
+    if not generator.compact_label:
+        stages.append({"name": "map_label_func", "map": map_label_func})
+
+    return stages + [
+        {"name": "map_image_func", "map": map_image_func},
+        {"name": "batch", "apply": generator.batch},
+        {"name": "prefetch", "apply": lambda x: x.prefetch(generator.prefetch_size)}
+    ]
+
+
+def profile_stages(generator: YOLOv4Dataset, num_of_img: int) -> Dict:
+    # run single threaded so the difference between two prefixes is the latency of one stage
+    dataset = generator.dataset.filter(lambda x: tf.shape(generator.get_bbox_and_label(x)[0])[0] != 0)
+    dataset = dataset.take(num_of_img + generator.batch_size).repeat()
+
+    # the source read is the baseline, every stage is measured on top of it
+    results = {}
+    previous = time_dataset(dataset, num_of_img)
+    results["read"] = previous / num_of_img * 1000
+    batched = False
+    for stage in get_stages(generator):
+        if "map" in stage:
+            dataset = dataset.map(stage["map"])
+        else:
+            dataset = stage["apply"](dataset)
+        batched = batched or stage["name"] == "batch"
+
+        num_of_element = num_of_img // generator.batch_size if batched else num_of_img
+        elapsed = time_dataset(dataset, num_of_element) * num_of_img / (num_of_element * (
+            generator.batch_size if batched else 1))
+        results[stage["name"]] = max(elapsed - previous, 0.) / num_of_img * 1000
+        previous = elapsed
+
+    return results
+
+
+def profile_pipeline(generator: YOLOv4Dataset, num_of_img: int) -> float:
+    # images/sec of the full get_dataset pipeline with the configured parallelism
+    num_of_batch = max(num_of_img // generator.batch_size, 1)
+    elapsed = time_dataset(generator.get_dataset().repeat(), num_of_batch)
+
+    return num_of_batch * generator.batch_size / elapsed
+
+
+def profile_train_step(batch_size: int, image_size: int, num_steps: int, warmup_steps: int) -> Dict:
+    # time spent blocked on the input iterator against time spent in the train step
+    trainer = Trainer(batch_size=batch_size, image_size=image_size)
+    iterator = iter(trainer.distribute_dataset(trainer.dataset_train.repeat()))
+
+    input_time, compute_time = 0., 0.
+    for step in range(warmup_steps + num_steps):
+        start = time.perf_counter()
+        data = next(iterator)
+        fetched = time.perf_counter()
+        loss, _ = trainer.train_one_step(data['image'], trainer.get_label(data))
+        float(loss)  # wait for the step to finish
+        done = time.perf_counter()
+
+        if step >= warmup_steps:
+            input_time += fetched - start
+            compute_time += done - fetched
+
+    return {
+        "input_wait_ms": input_time / num_steps * 1000,
+        "compute_ms": compute_time / num_steps * 1000,
+        "input_bound_ratio": input_time / (input_time + compute_time),
+        "images_per_sec": num_steps * batch_size / (input_time + compute_time)
+    }
+
+
+def write_summary(results: Dict, log_dir: str, step: int):
+    writer = tf.summary.create_file_writer(log_dir)
+    with writer.as_default():
+        for group, values in results.items():
+            if not isinstance(values, dict):
+                continue
+            for name, value in values.items():
+                tf.summary.scalar("{}/{}".format(group, name), value, step=step)
+    writer.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Profile the input pipeline throughput of a dataset')
+    parser.add_argument('-d', '--dataset', type=str, default=cfg.dataset,
+                        help='Dataset name, coco, wider_face, synthetic or local')
+    parser.add_argument('-b', '--batch_size', type=int, default=cfg.batch_size, help='Batch size')
+    parser.add_argument('-i', '--image_size', type=int, default=cfg.image_size, help='Reshape size of the image')
+    parser.add_argument('-n', '--num_of_img', type=int, default=256, help='Number of images to time per stage')
+    parser.add_argument('-s', '--train_steps', type=int, default=20,
+                        help='Number of train steps to time, 0 skips the train step')
+    parser.add_argument('-w', '--warmup_steps', type=int, default=3, help='Untimed train steps before timing')
+    parser.add_argument('-o', '--output', type=str, default='logs/profile/pipeline.json', help='JSON report path')
+    parser.add_argument('-l', '--log_dir', type=str, default='logs/profile', help='TensorBoard log directory')
+    parser.add_argument('--step', type=int, default=0, help='TensorBoard step, e.g. a release or build number')
+    args = parser.parse_args()
+
+    cfg.dataset = args.dataset
+
+    # stages are always profiled from the source records, the full pipeline uses the cache when one exists
+    generator = create_dataset_generator(args.dataset, args.image_size, args.batch_size, tfds.Split.TRAIN,
+                                         use_cache=False)
+    report = {
+        "dataset": args.dataset,
+        "batch_size": args.batch_size,
+        "image_size": args.image_size,
+        "stage_latency_ms": profile_stages(generator, args.num_of_img),
+        "pipeline": {
+            "images_per_sec": profile_pipeline(
+                create_dataset_generator(args.dataset, args.image_size, args.batch_size, tfds.Split.TRAIN),
+                args.num_of_img)
+        }
+    }
+    if args.train_steps > 0:
+        report["train_step"] = profile_train_step(args.batch_size, args.image_size, args.train_steps,
+                                                  args.warmup_steps)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    write_summary(report, os.path.join(args.log_dir, args.dataset), args.step)
+    print(json.dumps(report, indent=2))
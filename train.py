@@ -1,7 +1,11 @@
 import argparse
 import colorsys
 import datetime
-from typing import List, Tuple
+import glob
+import hashlib
+import json
+import os
+from typing import List, Tuple, Dict, Union
 
 import cv2
 import numpy as np
@@ -12,24 +16,25 @@ from config import cfg
 from dataset.coco_classes import coco_classes
 from dataset.wider_face_classes import wider_face_classes
 from dataset.yolov4_coco_dataset import COCO2017Dataset
+from dataset.yolov4_local_dataset import LocalDataset
+from dataset.yolov4_synthetic_dataset import SyntheticDataset
 from dataset.yolov4_wider_face_dataset import WiderFaceDatset
 from metrics.mean_average_precision.detection_map import DetectionMAP
 from model.loss import YOLOv4Loss
 from model.utils import non_max_suppression
 from model.yolov4 import YOLOv4
+from utils.distribute import setup_devices, create_strategy, is_chief
 from utils.lr_schedule import WarmUpLinearCosineDecay
+from utils.multi_scale import MultiScaleScheduler
 
-try:
-    physical_devices = tf.config.experimental.list_physical_devices("GPU")
-    tf.config.experimental.set_memory_growth(physical_devices[0], True)
-except:
-    pass
+setup_devices(cfg.num_virtual_devices)
 
 
 class Trainer:
     def __init__(self, batch_size: int, image_size: int):
-        # setup anchors
-        cfg.anchors.set_image_size(image_size)
+        # the default strategy runs on a single device
+        self.strategy = create_strategy(cfg.distribute_strategy)
+        self.is_chief = is_chief(self.strategy)
 
         # dataset
         dataset_train = self.create_dataset_generator(dataset=cfg.dataset, mode=tfds.Split.TRAIN, image_size=image_size,
@@ -38,7 +43,11 @@ class Trainer:
                                                     image_size=image_size, batch_size=batch_size)
         self.dataset_train = dataset_train.get_dataset()
         self.dataset_val = dataset_val.get_dataset()
-        self.class_names = self.create_class_names(dataset=cfg.dataset)
+        # batch_size is the global batch size, each replica gets batch_size / num_replicas_in_sync images
+        self.dist_dataset_train = self.distribute_dataset(self.dataset_train)
+        self.preprocess_image = dataset_train.preprocess_image
+        self.normalize_image = dataset_val.normalize_image
+        self.class_names = self.create_class_names(dataset=cfg.dataset, dataset_generator=dataset_train)
 
         # parameters
         self.batch_size = batch_size
@@ -49,25 +58,63 @@ class Trainer:
         self.yolo_iou_threshold = cfg.yolo_iou_threshold
         self.yolo_score_threshold = cfg.yolo_score_threshold
         self.label_smoothing_factor = cfg.label_smoothing_factor
-        self.lr_init = cfg.lr_init / self.batch_size
-        self.lr_end = cfg.lr_end / self.batch_size
+        # gradients of gradient_accumulation_steps batches are summed into one optimizer update
+        self.gradient_accumulation_steps = cfg.gradient_accumulation_steps
+        self.effective_batch_size = self.batch_size * self.gradient_accumulation_steps
+        self.lr_init = cfg.lr_init / self.effective_batch_size
+        self.lr_end = cfg.lr_end / self.effective_batch_size
         self.warmup_epochs = cfg.warmup_epochs
         self.train_epochs = cfg.train_epochs
-        self.warmup_steps = self.warmup_epochs * dataset_train.num_of_img / self.batch_size
-        self.total_steps = self.train_epochs * dataset_train.num_of_img / self.batch_size
+        # the lr schedule counts optimizer updates, i.e. effective batches
+        self.warmup_steps = self.warmup_epochs * dataset_train.num_of_img / self.effective_batch_size
+        self.total_steps = self.train_epochs * dataset_train.num_of_img / self.effective_batch_size
         self.step_to_log = cfg.step_to_log
-
-        # define model and loss
-        self.model = YOLOv4(num_class=self.num_class)
-        self.lr_scheduler = WarmUpLinearCosineDecay(warmup_steps=self.warmup_steps, decay_steps=self.total_steps,
-                                                    initial_learning_rate=self.lr_init)
-        self.optimizer = tf.keras.optimizers.Adam(learning_rate=self.lr_scheduler, clipnorm=1.0)
-        self.checkpoint_dir = './checkpoints/yolov4_train.tf'
-        self.ckpt = tf.train.Checkpoint(step=tf.Variable(1), optimizer=self.optimizer, net=self.model)
+        self.eval_num_of_batch = cfg.eval_num_of_batch
+        self.steps_per_execution = cfg.steps_per_execution
+
+        # augmentation, resizing and the optimizer update stay outside of the XLA cluster
+        if cfg.jit_compile:
+            if not cfg.static_shape:
+                raise ValueError("XLA compilation needs cfg.static_shape for fixed batch and bbox shapes")
+            self.compute_gradients = tf.function(self.compute_gradients, jit_compile=True)
+
+        # evaluate the same cached batches at every log step through long-lived iterators
+        self.eval_train_iterator = self.create_eval_iterator(self.dataset_train, "train")
+        self.eval_val_iterator = self.create_eval_iterator(self.dataset_val, "val")
+
+        # multi-scale training resizes each batch on device, labels are encoded at the same size by the loss
+        self.multi_scale = None
+        if cfg.multi_scale_image_sizes:
+            if not cfg.compact_label:
+                raise ValueError("Multi-scale training needs cfg.compact_label to encode labels per image size")
+            self.multi_scale = MultiScaleScheduler(cfg.multi_scale_image_sizes, cfg.multi_scale_steps)
+
+        # define model and loss, variables are mirrored on every replica
+        with self.strategy.scope():
+            self.model = YOLOv4(num_class=self.num_class)
+            self.lr_scheduler = WarmUpLinearCosineDecay(warmup_steps=self.warmup_steps,
+                                                        decay_steps=self.total_steps,
+                                                        initial_learning_rate=self.lr_init)
+            self.optimizer = tf.keras.optimizers.Adam(learning_rate=self.lr_scheduler, clipnorm=1.0)
+            # create the model and optimizer variables here rather than lazily inside a replica
+            self.model(tf.zeros((1, image_size, image_size, 3)))
+            if hasattr(self.optimizer, "build"):
+                self.optimizer.build(self.model.trainable_variables)
+            self.gradient_accumulators = self.create_gradient_accumulators()
+            # step counts batches, optimizer.iterations counts effective batches
+            if self.gradient_accumulators:
+                self.ckpt = tf.train.Checkpoint(step=tf.Variable(1), optimizer=self.optimizer, net=self.model,
+                                                gradient_accumulators=self.gradient_accumulators)
+            else:
+                self.ckpt = tf.train.Checkpoint(step=tf.Variable(1), optimizer=self.optimizer, net=self.model)
+            self.loss_fn = YOLOv4Loss(num_class=self.num_class, yolo_iou_threshold=self.yolo_iou_threshold,
+                                      label_smoothing_factor=self.label_smoothing_factor, use_ciou_loss=True,
+                                      use_focal_obj_loss=True, static_shape=cfg.static_shape,
+                                      from_logits=cfg.loss_from_logits)
+        # every worker has to save, only the chief writes to the real checkpoint directory
+        self.checkpoint_dir = './checkpoints/yolov4_train.tf' if self.is_chief else \
+            './checkpoints/workers/worker_{}'.format(self.strategy.cluster_resolver.task_id)
         self.manager = tf.train.CheckpointManager(self.ckpt, self.checkpoint_dir, max_to_keep=5)
-        self.loss_fn = YOLOv4Loss(num_class=self.num_class, yolo_iou_threshold=self.yolo_iou_threshold,
-                                  label_smoothing_factor=self.label_smoothing_factor, use_ciou_loss=True,
-                                  use_focal_obj_loss=True)
 
         # metrics
         self.mAP = DetectionMAP(self.num_class)
@@ -76,23 +123,80 @@ class Trainer:
         self.current_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
         self.train_log_dir = 'logs/yolov4/train'
         self.val_log_dir = 'logs/yolov4/val'
-        self.train_summary_writer = tf.summary.create_file_writer(self.train_log_dir)
-        self.val_summary_writer = tf.summary.create_file_writer(self.val_log_dir)
+        if self.is_chief:
+            self.train_summary_writer = tf.summary.create_file_writer(self.train_log_dir)
+            self.val_summary_writer = tf.summary.create_file_writer(self.val_log_dir)
+        else:
+            self.train_summary_writer = self.val_summary_writer = tf.summary.create_noop_writer()
 
     def create_dataset_generator(self, dataset, image_size, batch_size, mode):
         if dataset == "coco":
             return COCO2017Dataset(image_size=image_size, batch_size=batch_size, mode=mode)
         elif dataset == "wider_face":
             return WiderFaceDatset(image_size=image_size, batch_size=batch_size, mode=mode)
+        elif dataset == "synthetic":
+            return SyntheticDataset(image_size=image_size, batch_size=batch_size, mode=mode)
+        elif dataset == "local":
+            return LocalDataset(image_size=image_size, batch_size=batch_size, mode=mode)
         else:
             print("Unknown dataset!")
             exit(1)
 
-    def create_class_names(self, dataset):
+    def create_gradient_accumulators(self) -> List[tf.Variable]:
+        if self.gradient_accumulation_steps <= 1:
+            return []
+
+        # ON_READ keeps a local sum per replica, apply_gradients then all-reduces it once per update
+        return [tf.Variable(tf.zeros_like(variable), trainable=False,
+                            synchronization=tf.VariableSynchronization.ON_READ,
+                            aggregation=tf.VariableAggregation.SUM,
+                            name="gradient_accumulator_{}".format(i))
+                for i, variable in enumerate(self.model.trainable_variables)]
+
+    def distribute_dataset(self, dataset: tf.data.Dataset):
+        # split every global batch over the replicas, a single device consumes the dataset as is
+        if not cfg.distribute_strategy:
+            return dataset
+        return self.strategy.experimental_distribute_dataset(dataset)
+
+    def get_eval_cache_path(self, dataset: tf.data.Dataset, name: str) -> str:
+        # a cache is only valid for the same dataset, batches, image size, label mode and anchors
+        key = json.dumps({
+            "dataset": cfg.dataset,
+            "name": name,
+            "batch_size": self.batch_size,
+            "num_of_batch": self.eval_num_of_batch,
+            "element_spec": str(dataset.element_spec),
+            "anchors": cfg.anchors.yolo_anchors.tolist()
+        }, sort_keys=True)
+        key = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        cache_path = os.path.join(cfg.eval_cache_dir, "{}_{}_{}".format(cfg.dataset, name, key))
+
+        # a run killed while writing the cache leaves its lockfile behind, the unfinished cache is rewritten
+        for lockfile in glob.glob(cache_path + "*.lockfile"):
+            os.remove(lockfile)
+
+        return cache_path
+
+    def create_eval_iterator(self, dataset: tf.data.Dataset, name: str):
+        # the first eval_num_of_batch batches are cached and replayed forever
+        # only the chief writes to disk, other workers keep their batches in memory
+        cache_path = ""
+        if cfg.eval_cache_dir and self.is_chief:
+            os.makedirs(cfg.eval_cache_dir, exist_ok=True)
+            cache_path = self.get_eval_cache_path(dataset, name)
+
+        return iter(dataset.take(self.eval_num_of_batch).cache(cache_path).repeat())
+
+    def create_class_names(self, dataset, dataset_generator):
         if dataset == "coco":
             return coco_classes
         elif dataset == "wider_face":
             return wider_face_classes
+        elif dataset == "synthetic":
+            return ["class_{}".format(i) for i in range(cfg.synthetic_num_class)]
+        elif dataset == "local":
+            return dataset_generator.class_names
 
     def plot_bounding_box(self, images: tf.Tensor, bboxes, scores, class_ids, valid_detections):
         image = images.numpy()[0]
@@ -107,8 +211,9 @@ class Trainer:
         fontScale = 0.5
 
         image_h, image_w, _ = image.shape
-        image = (image + 1) / 2 * 255
-        image = image.astype(np.uint8)
+        if image.dtype != np.uint8:
+            image = (image + 1) / 2 * 255
+            image = image.astype(np.uint8)
 
         for i, (box, sc, cls) in enumerate(zip(bbox, score, class_id)):
             x1, y1, x2, y2 = box
@@ -132,6 +237,10 @@ class Trainer:
 
     @tf.function
     def validation(self, x: tf.Tensor, y: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]:
+        # uint8 images from the pipeline are only normalized, augmentation would change the fixed batches
+        if x.dtype == tf.uint8:
+            x = self.normalize_image(x)
+
         # calculate loss from validation dataset
         pred = self.model(x)
         pred_loss = self.loss_fn(y_pred=pred, y_true=y)
@@ -141,57 +250,137 @@ class Trainer:
 
         return pred_loss, bboxes, scores, classes, valid_detections
 
+    def get_multi_scale_shape(self, x: tf.Tensor, image_size: int) -> List:
+        # scale both sides of a (possibly aspect ratio bucketed) batch, keeping multiples of 32
+        shape = []
+        for i in (1, 2):
+            side = x.shape[i] if x.shape[i] is not None else tf.cast(tf.shape(x)[i], tf.float32)
+            side = side * image_size / self.image_size / 32
+            shape.append(int(round(side)) * 32 if isinstance(side, float) else tf.cast(tf.round(side), tf.int32) * 32)
+
+        return shape
+
     @tf.function
-    def train_one_step(self, x: tf.Tensor, y: tf.Tensor) -> List[tf.Tensor]:
-        with tf.GradientTape() as tape:
-            pred = self.model(x, training=True)
-            pred_loss = self.loss_fn(y_pred=pred, y_true=y)
-            regularization_loss = tf.reduce_sum(self.model.losses)
-            total_loss = pred_loss + regularization_loss
+    def train_one_step(self, x: tf.Tensor, y: tf.Tensor, image_size: int = None,
+                       apply_gradients: bool = True) -> Tuple[tf.Tensor, Dict[str, tf.Tensor]]:
+        return self.distributed_train_step(x, y, image_size, apply_gradients)
+
+    @tf.function
+    def train_n_steps(self, iterator, num_steps: tf.Tensor, image_size: int = None) -> Tuple[
+        tf.Tensor, Dict[str, tf.Tensor]]:
+        # run up to num_steps train steps in one graph, stops early when the epoch ends
+        # the loss and loss components of the last step are returned
+        loss = tf.constant(0.)
+        components = {"{}/{}".format(scale, name): tf.constant(0.) for scale in YOLOv4Loss.scale_names
+                      for name in YOLOv4Loss.component_names}
+        for _ in tf.range(num_steps):
+            data = iterator.get_next_as_optional()
+            if not data.has_value():
+                break
+            data = data.get_value()
+
+            if self.gradient_accumulators:
+                x, y = data['image'], self.get_label(data)
+                loss, components = tf.cond(self.ckpt.step % self.gradient_accumulation_steps == 0,
+                                           lambda: self.distributed_train_step(x, y, image_size, True),
+                                           lambda: self.distributed_train_step(x, y, image_size, False))
+            else:
+                loss, components = self.distributed_train_step(data['image'], self.get_label(data), image_size)
+            self.ckpt.step.assign_add(1)
+
+        return loss, components
+
+    def distributed_train_step(self, x: tf.Tensor, y: tf.Tensor, image_size: int = None,
+                               apply_gradients: bool = True) -> Tuple[tf.Tensor, Dict[str, tf.Tensor]]:
+        # x and y are per replica values when the dataset is distributed
+        pred_loss, components = self.strategy.run(self.replica_train_step, args=(x, y, image_size, apply_gradients))
+
+        # every replica sums the loss over its images, so the sum over replicas is the loss of the global batch
+        return tf.nest.map_structure(lambda value: self.strategy.reduce(tf.distribute.ReduceOp.SUM, value, axis=None),
+                                     (pred_loss, components))
+
+    def replica_train_step(self, x: tf.Tensor, y: tf.Tensor, image_size: int = None,
+                           apply_gradients: bool = True) -> Tuple[tf.Tensor, Dict[str, tf.Tensor]]:
+        if x.dtype == tf.uint8:
+            x = self.preprocess_image(x)
+
+        # bbox are normalized, so only the image is resized for multi-scale training
+        if image_size is not None and image_size != self.image_size:
+            x = tf.image.resize(x, self.get_multi_scale_shape(x, image_size))
+
+        pred_loss, components, grads = self.compute_gradients(x, y)
+
+        # the loss is summed over images, so the summed gradients are those of one effective batch
+        if self.gradient_accumulators:
+            for accumulator, grad in zip(self.gradient_accumulators, grads):
+                accumulator.assign_add(grad)
+            if not apply_gradients:
+                return pred_loss, components
+            grads = [accumulator.read_value() for accumulator in self.gradient_accumulators]
 
-        grads = tape.gradient(total_loss, self.model.trainable_variables)
         self.optimizer.apply_gradients(
             zip(grads, self.model.trainable_variables))
 
-        return pred_loss
+        for accumulator in self.gradient_accumulators:
+            accumulator.assign(tf.zeros_like(accumulator))
 
-    def log_metrics(self, writer: tf.summary.SummaryWriter, dataset: tf.data.Dataset):
-        data = next(iter(dataset))
-        loss, bboxes, scores, class_ids, valid_detections = self.validation(data['image'], data['label'])
+        return pred_loss, components
 
-        gt_boxes = data["bbox"]
-        num_of_gt_boxes = data["num_of_bbox"]
-
-        # calculate mAP
-        for frame in zip(bboxes.numpy(), class_ids.numpy(), scores.numpy(), valid_detections.numpy(),
-                         gt_boxes.numpy(),
-                         num_of_gt_boxes.numpy()):
-            pred_bbox, pred_cls, pred_score, valid_detection, gt_box, num_of_gt_box = frame
+    def compute_gradients(self, x: tf.Tensor, y: tf.Tensor) -> Tuple[tf.Tensor, Dict[str, tf.Tensor], List[tf.Tensor]]:
+        # forward and backward pass, jit compiled as one XLA cluster when cfg.jit_compile is set
+        with tf.GradientTape() as tape:
+            pred = self.model(x, training=True)
+            # the per scale box, confidence and class losses are logged from the same computation
+            components = self.loss_fn.get_loss_components(y_true=y, y_pred=pred)
+            pred_loss = tf.add_n(list(components.values()))
+            # gradients are summed over replicas and accumulated batches, count the regularization once
+            regularization_loss = tf.reduce_sum(self.model.losses) / (self.strategy.num_replicas_in_sync *
+                                                                      self.gradient_accumulation_steps)
+            total_loss = pred_loss + regularization_loss
 
-            # get all predicion and label
-            pred_bbox = pred_bbox[:valid_detection]
-            pred_cls = pred_cls[:valid_detection]
-            pred_score = pred_score[:valid_detection]
-            gt_box = gt_box[:num_of_gt_box]
-            gt_bbox = gt_box[..., :4]
-            gt_class_id = gt_box[..., 4]
+        grads = tape.gradient(total_loss, self.model.trainable_variables)
 
-            #
-            frame = pred_bbox, pred_cls, pred_score, gt_bbox, gt_class_id
-            self.mAP.evaluate(*frame)
+        return pred_loss, components, grads
+
+    @staticmethod
+    def get_label(data: Dict) -> Union[Tuple[tf.Tensor, tf.Tensor, tf.Tensor], Dict]:
+        # dense label grids, or the padded bbox that YOLOv4Loss encodes on device
+        if 'label' in data:
+            return data['label']
+        return {'bbox': data['bbox'], 'num_of_bbox': data['num_of_bbox']}
+
+    def log_metrics(self, writer: tf.summary.SummaryWriter, iterator):
+        losses = []
+        for i in range(self.eval_num_of_batch):
+            data = next(iterator)
+            loss, bboxes, scores, class_ids, valid_detections = self.validation(data['image'], self.get_label(data))
+            losses.append(loss)
+
+            # gt_boxes: tf.RaggedTensor, (batch_size, (n), (x1, y1, x2, y2, class_id))
+            gt_boxes = data["bbox"]
+            num_of_gt_boxes = data["num_of_bbox"]
+            if not isinstance(gt_boxes, tf.RaggedTensor):
+                gt_boxes = tf.RaggedTensor.from_tensor(gt_boxes, lengths=num_of_gt_boxes)
+
+            # calculate mAP
+            self.mAP.evaluate_batch(bboxes.numpy(), class_ids.numpy(), scores.numpy(), valid_detections.numpy(),
+                                    gt_boxes)
+
+            # plot the first image of the first batch
+            if i == 0:
+                pred_image = self.plot_bounding_box(data['image'], bboxes, scores, class_ids, valid_detections)
+                gt_box = gt_boxes[:1].to_tensor()
+                gt_image = self.plot_bounding_box(data['image'], gt_box[..., :4], tf.ones_like(gt_box[..., 4]),
+                                                  gt_box[..., 4], num_of_gt_boxes)
 
         mean_average_precision = self.mAP.get_mAP()
         self.mAP.reset_accumulators()
-
-        # plot image
-        pred_image = self.plot_bounding_box(data['image'], bboxes, scores, class_ids, valid_detections)
-        gt_image = self.plot_bounding_box(data['image'], gt_boxes[..., :4], tf.ones_like(scores), gt_boxes[..., 4],
-                                          num_of_gt_boxes)
+        loss = tf.reduce_mean(losses)
 
         # log tensorboard
         step = int(self.ckpt.step)
         with writer.as_default():
-            tf.summary.scalar("lr", self.optimizer.lr(step), step=step)
+            tf.summary.scalar("lr", self.optimizer.lr(self.optimizer.iterations), step=step)
             tf.summary.scalar('loss', loss, step=step)
             tf.summary.scalar('mean loss', loss.numpy() / self.batch_size,
                               step=step)
@@ -199,19 +388,76 @@ class Trainer:
             tf.summary.image("Display pred bounding box", pred_image, step=step)
             tf.summary.image("Display gt bounding box", gt_image, step=step)
 
+    def build_train_steps(self) -> Dict:
+        # trace one concrete train step per image size up front, switching size never retraces
+        # with gradient accumulation the accumulate-only step is traced as well
+        element_spec = self.dist_dataset_train.element_spec
+        apply_gradients = [True, False] if self.gradient_accumulators else [True]
+        return {(image_size, apply): self.train_one_step.get_concrete_function(element_spec['image'],
+                                                                               self.get_label(element_spec),
+                                                                               image_size, apply)
+                for image_size in self.multi_scale.image_sizes for apply in apply_gradients}
+
     def train_one_epoch(self):
-        for data in self.dataset_train:
-            loss = self.train_one_step(data['image'], data['label'])
+        if self.steps_per_execution > 1:
+            self.train_one_epoch_in_graph()
+            return
+
+        for data in self.dist_dataset_train:
+            # the optimizer updates on every gradient_accumulation_steps-th batch
+            apply_gradients = int(self.ckpt.step) % self.gradient_accumulation_steps == 0
+            if self.multi_scale:
+                image_size = self.multi_scale(int(self.ckpt.step))
+                loss, components = self.train_steps[(image_size, apply_gradients)](
+                    data['image'], self.get_label(data), image_size, apply_gradients)
+            else:
+                loss, components = self.train_one_step(data['image'], self.get_label(data),
+                                                       apply_gradients=apply_gradients)
             self.ckpt.step.assign_add(1)
 
             # validation every i steps
             if int(self.ckpt.step) % self.step_to_log == 0:
-                self.log_metrics(self.train_summary_writer, self.dataset_train)
-                self.log_metrics(self.val_summary_writer, self.dataset_val)
+                self.log_and_save(loss, components)
+
+    def train_one_epoch_in_graph(self):
+        # python only regains control at log, checkpoint and image size boundaries
+        iterator = iter(self.dist_dataset_train)
+        while True:
+            step = int(self.ckpt.step)
+            num_steps = min(self.steps_per_execution, self.step_to_log - step % self.step_to_log)
+            image_size = None
+            if self.multi_scale:
+                steps_per_size = self.multi_scale.steps_per_size
+                num_steps = min(num_steps, steps_per_size - step % steps_per_size)
+                image_size = self.multi_scale(step)
+
+            loss, components = self.train_n_steps(iterator, tf.constant(num_steps), image_size)
+            end_step = int(self.ckpt.step)
+
+            # validation every i steps
+            if end_step % self.step_to_log == 0 and end_step != step:
+                self.log_and_save(loss, components)
+
+            # the iterator ran out before num_steps
+            if end_step - step < num_steps:
+                break
 
-                # Save checkpoint
-                save_path = self.manager.save()
-                print("Saved checkpoint for step {}: {}".format(int(self.ckpt.step), save_path))
+    def log_train_step(self, loss: tf.Tensor, components: Dict[str, tf.Tensor]):
+        # loss of the last train step, no extra forward pass
+        step = int(self.ckpt.step)
+        with self.train_summary_writer.as_default():
+            tf.summary.scalar("train_step/loss", loss, step=step)
+            for name, value in components.items():
+                tf.summary.scalar("train_step/{}".format(name), value, step=step)
+
+    def log_and_save(self, loss: tf.Tensor, components: Dict[str, tf.Tensor]):
+        self.log_train_step(loss, components)
+        self.log_metrics(self.train_summary_writer, self.eval_train_iterator)
+        self.log_metrics(self.val_summary_writer, self.eval_val_iterator)
+
+        # Save checkpoint
+        save_path = self.manager.save()
+        print("Saved checkpoint for step {}: {}".format(int(self.ckpt.step), save_path))
 
     def train(self):
         self.ckpt.restore(self.manager.latest_checkpoint)
@@ -220,6 +466,10 @@ class Trainer:
         else:
             print("Initializing from scratch.")
 
+        # train_n_steps traces once per image size on first use instead
+        if self.multi_scale and self.steps_per_execution == 1:
+            self.train_steps = self.build_train_steps()
+
         for e in range(self.train_epochs):
             self.train_one_epoch()
 
@@ -0,0 +1,32 @@
+import tensorflow as tf
+
+
+# colour jitter for a single image (h, w, c) or a batch (..., h, w, c), each image draws its own factor
+
+
+def random_factor(images: tf.Tensor, minval: float, maxval: float) -> tf.Tensor:
+    # shape = (..., 1, 1, 1)
+    shape = tf.concat([tf.shape(images)[:-3], [1, 1, 1]], axis=0)
+    return tf.random.uniform(shape, minval=minval, maxval=maxval)
+
+
+def random_brightness(images: tf.Tensor, max_delta: float) -> tf.Tensor:
+    return images + random_factor(images, -max_delta, max_delta)
+
+
+def random_contrast(images: tf.Tensor, lower: float, upper: float) -> tf.Tensor:
+    mean = tf.reduce_mean(images, axis=(-3, -2), keepdims=True)
+    return (images - mean) * random_factor(images, lower, upper) + mean
+
+
+def random_hue(images: tf.Tensor, max_delta: float) -> tf.Tensor:
+    hue, saturation, value = tf.unstack(tf.image.rgb_to_hsv(images), axis=-1)
+    delta = random_factor(images, -max_delta, max_delta)[..., 0]
+    hue = tf.math.floormod(hue + delta, 1.0)
+    return tf.image.hsv_to_rgb(tf.stack([hue, saturation, value], axis=-1))
+
+
+def random_saturation(images: tf.Tensor, lower: float, upper: float) -> tf.Tensor:
+    hue, saturation, value = tf.unstack(tf.image.rgb_to_hsv(images), axis=-1)
+    saturation = tf.clip_by_value(saturation * random_factor(images, lower, upper)[..., 0], 0.0, 1.0)
+    return tf.image.hsv_to_rgb(tf.stack([hue, saturation, value], axis=-1))
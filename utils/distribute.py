@@ -0,0 +1,41 @@
+import tensorflow as tf
+
+
+def setup_devices(num_virtual_devices: int = 0):
+    # must run before any op initializes the runtime
+    try:
+        for device in tf.config.list_physical_devices("GPU"):
+            tf.config.experimental.set_memory_growth(device, True)
+
+        # split the CPU into logical devices so multi replica training can be tested without GPUs
+        if num_virtual_devices > 1:
+            tf.config.set_logical_device_configuration(
+                tf.config.list_physical_devices("CPU")[0],
+                [tf.config.LogicalDeviceConfiguration() for _ in range(num_virtual_devices)]
+            )
+    except RuntimeError as e:
+        print("Devices already initialized: {}".format(e))
+
+
+def create_strategy(name: str) -> tf.distribute.Strategy:
+    if name == "mirrored":
+        # all GPUs, or all logical CPUs when there is no GPU
+        devices = tf.config.list_logical_devices("GPU") or tf.config.list_logical_devices("CPU")
+        return tf.distribute.MirroredStrategy(devices=[device.name for device in devices])
+    elif name == "multi_worker":
+        # the cluster is read from the TF_CONFIG environment variable
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    elif not name:
+        return tf.distribute.get_strategy()
+    else:
+        raise ValueError("Unknown distribute strategy: {}".format(name))
+
+
+def is_chief(strategy: tf.distribute.Strategy) -> bool:
+    # only the chief writes summaries and the real checkpoint
+    cluster_resolver = getattr(strategy, "cluster_resolver", None)
+    if cluster_resolver is None or not cluster_resolver.task_type:
+        return True
+
+    return cluster_resolver.task_type == "chief" or (cluster_resolver.task_type == "worker" and
+                                                     cluster_resolver.task_id == 0)
@@ -0,0 +1,15 @@
+from typing import List
+
+import numpy as np
+
+
+class MultiScaleScheduler:
+    def __init__(self, image_sizes: List[int], steps_per_size: int, seed: int = 0):
+        self.image_sizes = sorted(image_sizes)
+        self.steps_per_size = steps_per_size
+        self.seed = seed
+
+    def __call__(self, step: int) -> int:
+        # the size only depends on the step, so a restored run continues the same schedule
+        period = step // self.steps_per_size
+        return int(np.random.RandomState(self.seed + period).choice(self.image_sizes))